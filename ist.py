@@ -12,21 +12,76 @@ version = '1.1'
 
 import sys, os
 import argparse
-import socket, struct
-import requests
+import binascii
+import copy
+import csv
+import hashlib
+import importlib
+import json
+import shlex
+import socket
+import tempfile
+import textwrap
+import threading
+import time
+import zipfile
+import zlib
+try:
+    import queue # python3
+except ImportError:
+    import Queue as queue # python2
 try:
     from urllib.parse import urlencode # python3
 except:
     from urllib import urlencode # python2
-from datetime import datetime
-from lxml import etree
-from prettytable import PrettyTable
+try:
+    input = raw_input # python2
+except NameError:
+    pass
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
 from uuid import UUID
 
+class LazyImport(object):
+    """ stand-in for a module, or a name in it, imported on first use.
+        Loading rebinds the global 'binding' to the real object, so only
+        the first access goes through the stand-in. Commands which never
+        touch the network or a table do not pay for the imports. """
+    def __init__(self, binding, module, name=None):
+        self.binding = binding
+        self.module = module
+        self.name = name
+
+    def load(self):
+        target = importlib.import_module(self.module)
+        if self.name:
+            target = getattr(target, self.name)
+        globals()[self.binding] = target
+        return target
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+    def __call__(self, *args, **kwargs):
+        return self.load()(*args, **kwargs)
+
+requests = LazyImport('requests', 'requests')
+etree = LazyImport('etree', 'lxml.etree')
+PrettyTable = LazyImport('PrettyTable', 'prettytable', 'PrettyTable')
+
 debug = False
 Default_Max_Width = 36
+Stream_Sample_Rows = 100
 proxy = None
 token = None
+prefetch = 0
+pool_size = 10
+workers = 8
+cache = None
+capture = None
+profile = None
+scheduler = None
+engine = None
 
 ServiceMap = {
     "vr": "contrail-vrouter-agent",
@@ -48,100 +103,1038 @@ ServiceMap = {
     "nodemgr_analytics": "contrail-analytics-nodemgr",
 }
 
+# Record element of each request's output. Streamed commands loading a
+# --file parse it incrementally and render one record at a time.
+RecordTags = {
+    "Snh_ShowRouteReq": "ShowRoute",
+    "Snh_ShowRouteSummaryReq": "ShowRouteTableSummary",
+    "Snh_ShowRoutingInstanceReq": "ShowRoutingInstance",
+    "Snh_BgpNeighborReq": "BgpNeighborResp",
+    "Snh_IFMapTableShowReq": "IFMapNodeShowInfo",
+    "Snh_IFMapLinkTableShowReq": "IFMapLinkShowInfo",
+    "Snh_Inet4UcRouteReq": "RouteUcSandeshData",
+    "Snh_Inet6UcRouteReq": "RouteUcSandeshData",
+    "Snh_BridgeRouteReq": "RouteL2SandeshData",
+    "Snh_Layer2RouteReq": "RouteL2SandeshData",
+    "Snh_EvpnRouteReq": "RouteEvpnSandeshData",
+    "Snh_ItfReq": "ItfSandeshData",
+    "Snh_KInterfaceReq": "KInterfaceInfo",
+    "Snh_NhListReq": "NhSandeshData",
+    "Snh_MplsReq": "MplsSandeshData",
+    "Snh_VnListReq": "VnSandeshData",
+    "Snh_VrfListReq": "VrfSandeshData",
+}
+
+# Compiled XPath objects by expression. Expressions are evaluated once per
+# page, route or path, so compile each of them only once.
+XPath_Cache = {}
+XPath_Cache_Size = 256
+
+def compile_xpath(expr):
+    """ return the compiled etree.XPath of expr """
+    xp = XPath_Cache.get(expr)
+    if xp is None:
+        if len(XPath_Cache) >= XPath_Cache_Size:
+            XPath_Cache.clear()
+        xp = etree.XPath(expr)
+        if profile:
+            xp = profile.timed('xpath', xp)
+        XPath_Cache[expr] = xp
+    return xp
+
+class IntrospectError(Exception):
+    """ introspect output could not be retrieved or loaded """
+    pass
+
+class PageCache:
+    """ on-disk cache of raw introspect pages keyed by their full url.
+        Files are written to a temporary name and renamed into place, so
+        concurrent ist processes only ever read complete pages. The
+        default directory is private to the user, and only pages written
+        by the user are read, so other local users cannot plant pages.
+        Expired pages are deleted by put() at most once per ttl, and by
+        clear(). """
+    def __init__ (self, ttl, directory=None):
+        self.ttl = ttl
+        self.uid = os.getuid() if hasattr(os, 'getuid') else None
+        # pages cached before this time are ignored, see clear()
+        self.since = 0
+        self.pruned = 0
+        self.directory = directory or os.path.join(
+            tempfile.gettempdir(), 'ist-cache-%s' % (self.uid or 0))
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        try:
+            os.makedirs(self.directory, 0o700)
+        except OSError:
+            pass
+
+    def filename(self, url):
+        return os.path.join(self.directory,
+                            hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+    def get(self, url):
+        """ cached page for url, or None if missing or expired """
+        filename = self.filename(url)
+        data = None
+        try:
+            with open(filename, 'rb') as f:
+                st = os.fstat(f.fileno())
+                if ((self.uid is None or st.st_uid == self.uid) and
+                        time.time() - st.st_mtime < self.ttl and
+                        st.st_mtime >= self.since):
+                    data = f.read()
+        except (IOError, OSError):
+            pass
+        with self.lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if debug:
+            print("DEBUG: cache %s for url %s" %
+                  ('miss' if data is None else 'hit', url))
+        return data
+
+    def put(self, url, data):
+        try:
+            fd, tmpname = tempfile.mkstemp(dir=self.directory)
+        except (IOError, OSError) as e:
+            if debug: print("DEBUG: failed to cache url %s: %s" % (url, e))
+            return
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmpname, self.filename(url))
+        except (IOError, OSError) as e:
+            if debug: print("DEBUG: failed to cache url %s: %s" % (url, e))
+            try:
+                os.unlink(tmpname)
+            except OSError:
+                pass
+        now = time.time()
+        if now - self.pruned >= self.ttl:
+            self.pruned = now
+            self.prune(now - self.ttl)
+
+    def prune(self, before):
+        """ delete the pages, and temporary files left by interrupted
+            writes, of the user last written before 'before' """
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            filename = os.path.join(self.directory, name)
+            try:
+                st = os.lstat(filename)
+                if ((self.uid is None or st.st_uid == self.uid) and
+                        st.st_mtime < before):
+                    os.unlink(filename)
+            except OSError:
+                pass
+
+    def clear(self):
+        """ ignore the pages cached so far, by this or other processes """
+        self.since = time.time()
+        self.prune(self.since)
+
+class MemoryCache:
+    """ PageCache stand-in keeping pages in memory, for ist shell and ist
+        serve. Pages are kept until cleared, or for ttl seconds when set.
+        The oldest pages are dropped beyond 'limit' bytes. """
+    def __init__ (self, ttl=None, limit=256 * 1024 * 1024):
+        self.ttl = ttl
+        self.limit = limit
+        self.size = 0
+        self.pages = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, url):
+        with self.lock:
+            data = None
+            if url in self.pages:
+                stamp, data = self.pages[url]
+                if self.ttl and time.time() - stamp >= self.ttl:
+                    data = None
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if debug:
+            print("DEBUG: cache %s for url %s" %
+                  ('miss' if data is None else 'hit', url))
+        return data
+
+    def put(self, url, data):
+        with self.lock:
+            if url in self.pages:
+                self.size -= len(self.pages.pop(url)[1])
+            self.pages[url] = (time.time(), data)
+            self.size += len(data)
+            while self.size > self.limit and len(self.pages) > 1:
+                self.size -= len(self.pages.popitem(last=False)[1][1])
+
+    def clear(self):
+        with self.lock:
+            self.pages.clear()
+            self.size = 0
+
+class PageArchive:
+    """ zip archive of introspect pages in the order they were fetched.
+        Each member holds one page, its comment holds the request path
+        the page was fetched with. """
+    def __init__ (self, filename, mode='r'):
+        self.filename = filename
+        self.zip = zipfile.ZipFile(filename, mode, zipfile.ZIP_DEFLATED)
+        self.lock = threading.Lock()
+        self.pages = {}
+        for info in self.zip.infolist():
+            path = info.comment.decode('utf-8')
+            if path not in self.pages:
+                self.pages[path] = info.filename
+
+    def add(self, path, data):
+        with self.lock:
+            info = zipfile.ZipInfo('pages/%06d.xml' % len(self.zip.infolist()),
+                                   time.localtime()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.comment = path.encode('utf-8')
+            self.zip.writestr(info, data)
+
+    def get(self, path):
+        if path not in self.pages:
+            raise IntrospectError("ERROR: %s was not captured in %s" %
+                                  (path, self.filename))
+        with self.lock:
+            return self.zip.read(self.pages[path])
+
+    def close(self):
+        self.zip.close()
+
+class PrefixIndex:
+    """ longest prefix match index over the routes of one family.
+        Prefixes are kept in one hash table per prefix length, keyed by
+        their network bits, so a lookup probes at most one key per length
+        present in the table (33 for IPv4, 129 for IPv6). """
+    def __init__ (self, family):
+        if family == 'inet6':
+            self.af, self.bits = socket.AF_INET6, 128
+        else:
+            self.af, self.bits = socket.AF_INET, 32
+        self.tables = {}
+
+    def address(self, addr):
+        return int(binascii.hexlify(socket.inet_pton(self.af, addr)), 16)
+
+    def insert(self, prefix, value):
+        try:
+            netaddr, plen = prefix.split('/')
+            plen = int(plen)
+            key = self.address(netaddr) >> (self.bits - plen)
+        except (ValueError, socket.error):
+            if debug: print("DEBUG: skipping invalid prefix " + prefix)
+            return
+        self.tables.setdefault(plen, {})[key] = value
+
+    def covers(self, prefix, addr):
+        """ length of prefix if it covers addr, an address() value, else
+            None """
+        try:
+            netaddr, plen = prefix.split('/')
+            plen = int(plen)
+            shift = self.bits - plen
+            if self.address(netaddr) >> shift == addr >> shift:
+                return plen
+        except (ValueError, socket.error):
+            pass
+        return None
+
+    def lookup(self, addr):
+        """ values of the prefixes covering addr, the longest match last """
+        addr = self.address(addr)
+        chain = []
+        for plen in sorted(self.tables):
+            value = self.tables[plen].get(addr >> (self.bits - plen))
+            if value is not None:
+                chain.append(value)
+        return chain
+
+class StreamTable:
+    """ PrettyTable look-alike writing every row as soon as it is added.
+        With max_width, every column is max_width wide. Otherwise column
+        widths are fixed from the header and the first 'sample' rows, with
+        Headroom for longer cells to come, up to Default_Max_Width.
+        Longer cells are wrapped between words: a word longer than its
+        column overflows it rather than being cut. """
+    Headroom = 0.25
+
+    def __init__ (self, fields, max_width, sample):
+        self.fields = fields
+        self.max_width = max_width
+        self.sample = sample
+        self.rows = []
+        self.widths = None
+
+    def add_row(self, row):
+        if self.widths is None:
+            self.rows.append(row)
+            if len(self.rows) < self.sample:
+                return
+            self.start()
+        else:
+            self.write(row)
+
+    def start(self):
+        if self.max_width:
+            self.widths = [self.max_width] * len(self.fields)
+        else:
+            self.widths = [len(f) for f in self.fields]
+            for row in self.rows:
+                for i, cell in enumerate(row[:len(self.fields)]):
+                    for line in str(cell).split('\n'):
+                        self.widths[i] = max(self.widths[i], len(line))
+            self.widths = [max(1, min(w + max(2, int(w * self.Headroom)),
+                                      Default_Max_Width))
+                           for w in self.widths]
+        self.border = '+' + '+'.join('-' * (w + 2) for w in self.widths) + '+'
+        print(self.border)
+        self.write(self.fields)
+        print(self.border)
+        for row in self.rows:
+            self.write(row)
+        self.rows = []
+
+    def write(self, row):
+        cells = [str(row[i]) if i < len(row) else ''
+                 for i in range(len(self.widths))]
+        if all(len(cell) <= width and '\n' not in cell
+               for cell, width in zip(cells, self.widths)):
+            print('| ' + ' | '.join(cell.ljust(width) for cell, width
+                                    in zip(cells, self.widths)) + ' |')
+            return
+        wrapped = []
+        for cell, width in zip(cells, self.widths):
+            lines = []
+            for line in cell.split('\n'):
+                if len(line) <= width:
+                    lines.append(line)
+                else:
+                    lines += textwrap.wrap(line, width,
+                                           break_long_words=False,
+                                           break_on_hyphens=False)
+            wrapped.append(lines)
+        output = []
+        for n in range(max(len(lines) for lines in wrapped)):
+            output.append('| ' + ' | '.join(
+                (lines[n] if n < len(lines) else '').ljust(width)
+                for lines, width in zip(wrapped, self.widths)) + ' |')
+        print('\n'.join(output))
+
+    def close(self):
+        if self.widths is None:
+            self.start()
+        print(self.border)
+
+class RecordWriter:
+    """ writes records as soon as they are produced: json (one array),
+        ndjson (one object per line) or csv (a header, then one row per
+        record). With 'records' set to a list, (record, fields) pairs are
+        collected into it instead. """
+    def __init__ (self, format, records=None):
+        self.format = format
+        self.count = 0
+        self.csv = None
+        self.records = records
+
+    def write(self, record, fields=None):
+        """ record is a dict for json/ndjson, a list of cells matching
+            fields for csv """
+        if self.records is not None:
+            self.records.append((record, fields))
+        elif self.format == 'csv':
+            if self.csv is None:
+                self.csv = csv.writer(sys.stdout, lineterminator='\n')
+                self.csv.writerow(fields)
+            self.csv.writerow(record)
+        elif self.format == 'ndjson':
+            print(json.dumps(record))
+        else:
+            print(('[' if not self.count else ',') + json.dumps(record))
+        self.count += 1
+
+    def close(self):
+        if self.format == 'json' and self.records is None:
+            print(']' if self.count else '[]')
+
+class Scheduler:
+    """ admission of introspect requests, shared by all threads:
+        - at most 'per_host' requests in flight per host, lowered by half
+          (AIMD) when a response takes 'slowdown' times longer than the
+          fastest one seen for that request, or the server answers 429
+          or 5xx, and raised back by one per limit fast responses
+        - at most 'rate' requests per second overall, in bursts of 'burst'
+        - with load_aware, one request at a time to a host whose one
+          minute load per cpu (Snh_CpuLoadInfoReq) is above max_load """
+    Load_Interval = 30
+    Min_Slow = 0.05
+
+    def __init__(self, per_host=4, rate=None, burst=None, slowdown=3.0,
+                 load_aware=False, max_load=0.8):
+        self.per_host = per_host
+        self.rate = rate
+        self.burst = burst or max(1.0, rate or 0)
+        self.slowdown = slowdown
+        self.load_aware = load_aware
+        self.max_load = max_load
+        self.cond = threading.Condition()
+        self.hosts = {}
+        self.tokens = self.burst
+        self.stamp = time.time()
+
+    def host(self, key):
+        if key not in self.hosts:
+            self.hosts[key] = {'active': 0, 'limit': float(self.per_host),
+                               'baseline': {}, 'decreased': 0,
+                               'load': None, 'load_time': None,
+                               'probing': False}
+        return self.hosts[key]
+
+    def limit(self, state):
+        if state['load'] is not None and state['load'] > self.max_load:
+            return 1
+        return max(1, int(state['limit']))
+
+    def token(self):
+        """ take a token of the bucket, sleeping until one is available """
+        with self.cond:
+            now = time.time()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+    def request(self, key, path, get, probe=None):
+        """ get() once key, the host, admits one more request """
+        with self.cond:
+            state = self.host(key)
+            probing = (self.load_aware and probe is not None and
+                       (state['load_time'] is None or
+                        time.time() - state['load_time'] >=
+                        self.Load_Interval))
+            if probing:
+                state['load_time'] = time.time()
+                state['probing'] = True
+        if probing:
+            load = probe()
+            with self.cond:
+                state['load'] = load
+                state['probing'] = False
+                self.cond.notify_all()
+                if debug: print("DEBUG: scheduler %s load per cpu %s" %
+                                (key, load))
+        with self.cond:
+            # other requests wait for the load of the host
+            while (state['probing'] and not probing or
+                   state['active'] >= self.limit(state)):
+                self.cond.wait()
+            state['active'] += 1
+        if self.rate:
+            self.token()
+        start = time.time()
+        status = None
+        try:
+            response = get()
+            status = response.status_code
+            return response
+        finally:
+            self.release(key, state, path.split('?')[0], start,
+                         time.time() - start, status)
+
+    def release(self, key, state, name, start, elapsed, status):
+        with self.cond:
+            state['active'] -= 1
+            if status is not None:
+                baseline = state['baseline'].get(name, elapsed)
+                state['baseline'][name] = min(baseline, elapsed)
+                slow = (elapsed > self.Min_Slow and
+                        elapsed > self.slowdown * baseline)
+                old = state['limit']
+                if slow or status == 429 or status >= 500:
+                    # requests started before the last decrease do not
+                    # decrease the limit again
+                    if start > state['decreased']:
+                        state['limit'] = max(1.0, old / 2)
+                        state['decreased'] = time.time()
+                else:
+                    state['limit'] = min(float(self.per_host),
+                                         old + 1.0 / old)
+                if debug and int(old) != int(state['limit']):
+                    print("DEBUG: scheduler %s limit %d -> %d (%s took "
+                          "%.3fs, fastest %.3fs, status %s)" %
+                          (key, old, state['limit'], name, elapsed,
+                           state['baseline'][name], status))
+            self.cond.notify_all()
+
+if hasattr(time, 'thread_time'):
+    cpu_time = time.thread_time
+elif hasattr(time, 'process_time'):
+    cpu_time = time.process_time
+else:
+    cpu_time = time.clock
+
+class Profile:
+    """ wall and cpu time per phase of a run. Only --profile runs create
+        one and wrap the hot functions with its timers, so that the
+        normal code paths carry no timing code. Time spent in a nested
+        phase is accounted to that phase only. """
+    def __init__ (self):
+        self.wall = {}
+        self.cpu = {}
+        self.calls = {}
+        self.pages = 0
+        self.bytes = 0
+        self.wire_bytes = 0
+        self.records = 0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.started = (time.time(), cpu_time())
+
+    def enter(self, phase):
+        stack = self.local.__dict__.setdefault('stack', [])
+        now = (time.time(), cpu_time())
+        if stack:
+            self.charge(stack[-1][0], stack[-1][1], now)
+        stack.append([phase, now])
+
+    def exit(self):
+        stack = self.local.stack
+        phase, since = stack.pop()
+        now = (time.time(), cpu_time())
+        self.charge(phase, since, now)
+        with self.lock:
+            self.calls[phase] = self.calls.get(phase, 0) + 1
+        if stack:
+            stack[-1][1] = now
+
+    def charge(self, phase, since, now):
+        with self.lock:
+            self.wall[phase] = self.wall.get(phase, 0) + now[0] - since[0]
+            self.cpu[phase] = self.cpu.get(phase, 0) + now[1] - since[1]
+
+    def timed(self, phase, func):
+        """ func accounting its calls to phase """
+        def timed_func(*args, **kwargs):
+            self.enter(phase)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.exit()
+        return timed_func
+
+    def timed_iter(self, phase, iterator):
+        """ iterator accounting the production of its items to phase """
+        while True:
+            self.enter(phase)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.exit()
+            yield item
+
+    def counted(self, func):
+        """ func counting its calls as emitted records """
+        def counted_func(*args, **kwargs):
+            with self.lock:
+                self.records += 1
+            return func(*args, **kwargs)
+        return counted_func
+
+    def instrument(self, trace_memory=False):
+        """ wrap the network, parse, xpath and output functions. XPath
+            objects are wrapped by compile_xpath as they are compiled.
+            Tracing python allocations slows a run down several times,
+            so it is only done with trace_memory. """
+        profiled = self
+
+        def fetch(IST, path, fetch=Introspect.fetch):
+            page = fetch(IST, path)
+            with profiled.lock:
+                profiled.pages += 1
+                profiled.bytes += len(page)
+            return page
+        Introspect.fetch = self.timed('network', fetch)
+
+        def transferred(IST, url, wire, size, encoding,
+                        transferred=Introspect.transferred):
+            with profiled.lock:
+                profiled.wire_bytes += wire
+            transferred(IST, url, wire, size, encoding)
+        Introspect.transferred = transferred
+        Introspect.parse_page = self.timed('parse', Introspect.parse_page)
+
+        for name in ['tblRow', 'pathToStr', 'routeToStr_VR']:
+            setattr(Introspect, name,
+                    staticmethod(self.counted(getattr(Introspect, name))))
+        elementToStr = Introspect.elementToStr
+        def topElementToStr(indent, etreenode):
+            if indent == '':
+                with profiled.lock:
+                    profiled.records += 1
+            return elementToStr(indent, etreenode)
+        Introspect.elementToStr = staticmethod(topElementToStr)
+        RecordWriter.write = self.counted(RecordWriter.write)
+
+        if trace_memory:
+            try:
+                import tracemalloc
+                tracemalloc.start()
+            except ImportError:
+                print("Warning: tracemalloc needs python 3.4")
+
+    def report(self):
+        """ the profile as a dict. 'render' is the time of the command
+            outside the other phases: output formatting and the glue. """
+        wall = time.time() - self.started[0]
+        cpu = cpu_time() - self.started[1]
+        phases = OrderedDict()
+        for phase in ['network', 'parse', 'xpath', 'render']:
+            phases[phase] = OrderedDict([
+                ('wall', round(self.wall.get(phase, 0), 6)),
+                ('cpu', round(self.cpu.get(phase, 0), 6)),
+                ('calls', self.calls.get(phase, 0))])
+        report = OrderedDict([
+            ('phases', phases),
+            ('wall', round(wall, 6)),
+            ('cpu', round(cpu, 6)),
+            ('pages', self.pages),
+            ('bytes', self.bytes),
+            ('wire_bytes', self.wire_bytes),
+            ('records', self.records),
+            ('peak_traced_memory', None),
+            ('peak_rss', None)])
+        try:
+            import tracemalloc
+            if tracemalloc.is_tracing():
+                report['peak_traced_memory'] = \
+                    tracemalloc.get_traced_memory()[1]
+        except ImportError:
+            pass
+        try:
+            import resource
+            report['peak_rss'] = \
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        except ImportError:
+            pass
+        return report
+
+    def printReport(self, filename=None):
+        """ print the report to stderr, or write it as json to filename """
+        report = self.report()
+        if filename:
+            with open(filename, 'w') as f:
+                json.dump(report, f, indent=2)
+                f.write('\n')
+            return
+        tbl = Introspect.newTbl(['phase', 'wall s', 'cpu s', 'calls'],
+                                Default_Max_Width)
+        for phase, p in report['phases'].items():
+            tbl.add_row([phase, '%.3f' % p['wall'], '%.3f' % p['cpu'],
+                         p['calls']])
+        tbl.add_row(['total', '%.3f' % report['wall'],
+                     '%.3f' % report['cpu'], ''])
+        sys.stderr.write('%s\n' % tbl)
+        memory = ', '.join('%s %.1f MB' % (name, report[key] / 1048576.0)
+                           for name, key in [('peak traced', 'peak_traced_memory'),
+                                             ('peak RSS', 'peak_rss')]
+                           if report[key] is not None)
+        sys.stderr.write('pages %d, bytes %d (%d downloaded on the wire), '
+                         'records %d%s\n' %
+                         (report['pages'], report['bytes'],
+                          report['wire_bytes'], report['records'],
+                          ', ' + memory if memory else ''))
+
 class Introspect:
     def __init__ (self, host, port, filename):
 
+        self.host = host
+        self.port = port
         self.host_url = "http://" + host + ":" + str(port) + "/"
         self.filename = filename
-
-    def get (self, path):
-        """ get introspect output """
-        self.output_etree = []
-
-        # load xml output from given file
-        if self.filename:
-            try:
-                print("Loadding from introspect xml %s" % self.filename)
-                self.output_etree.append(etree.parse(self.filename))
-            except Exception as inst:
-                print("ERROR: parsing %s failed " % self.filename)
-                print(inst)
-                sys.exit(1)
+        self.session = None
+        self.archive = None
+        if filename and zipfile.is_zipfile(filename):
+            # replay the pages of a --capture archive
+            self.archive = PageArchive(filename)
+            self.filename = None
+        # when set to a list, printTbl collects (fields, rows) into it
+        # instead of printing the table
+        self.tables = None
+        # likewise for the json, ndjson and csv records
+        self.records = None
+
+    def connect(self):
+        """ keep-alive session shared by all requests of this instance """
+        if self.session is None:
+            self.session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                                    pool_maxsize=pool_size)
+            self.session.mount('http://', adapter)
+            self.session.mount('https://', adapter)
+            self.session.headers['Accept-Encoding'] = 'gzip, deflate'
+            if proxy and token:
+                self.session.headers['X-Auth-Token'] = token
+        return self.session
+
+    def close(self):
+        """ release pooled connections, report their reuse in debug mode """
+        if self.session is None:
+            return
+        if debug:
+            for adapter in set(self.session.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    pool = pools[key]
+                    print("DEBUG: %s:%s %d requests over %d connections "
+                          "(%d reused)" %
+                          (pool.host, pool.port, pool.num_requests,
+                           pool.num_connections,
+                           pool.num_requests - pool.num_connections))
+        self.session.close()
+        self.session = None
+
+    def get (self, path, stream=False):
+        """ get introspect output.
+            With stream set, pages are fetched lazily while the caller walks
+            self.output_etree, so each page is freed once it is rendered. """
+        if prefetch and not self.filename:
+            pages = self.prefetch_pages(path)
         else:
-            while True:
-                url = self.host_url + path.replace(' ', '%20')
-                headers = {}
-                if proxy and token:
-                    url = proxy + "/forward-proxy?" + urlencode({'proxyURL': url})
-                    headers['X-Auth-Token'] = token
-                if debug: print("DEBUG: retrieving url " + url)
-                try:
-                    response = requests.get(url,headers=headers)
-                    response.raise_for_status()
-                except requests.exceptions.HTTPError:
-                    print('The server couldn\'t fulfill the request.')
-                    print('URL: ' + url)
-                    print('Error code: ', response.status_code)
-                    print('Error text: ', response.text)
-                    sys.exit(1)
-                except requests.exceptions.RequestException as e:
-                    print('Failed to reach destination')
-                    print('URL: ' + url)
-                    print('Reason: ', e)
-                    sys.exit(1)
+            pages = self.iter_pages(path, stream)
+        if stream:
+            self.output_etree = pages
+        else:
+            self.output_etree = list(pages)
+
+    def iter_records(self, tag):
+        """ parse self.filename incrementally, yielding a small document
+            for each 'tag' record as soon as it is complete. Rendered
+            records and completed containers are dropped, so memory holds
+            about one record rather than the whole file. """
+        sys.stderr.write("Loadding from introspect xml %s\n" %
+                         self.filename)
+        parent = skeleton = None
+        try:
+            events = etree.iterparse(self.filename, tag=tag, huge_tree=True)
+            if profile:
+                events = profile.timed_iter('parse', events)
+            for event, record in events:
+                if record.getparent() is not parent:
+                    # first record of a new container
+                    parent = record.getparent()
+                    ancestors = list(record.iterancestors())
+                    for ancestor in ancestors:
+                        # earlier instances of the same container are done
+                        previous = ancestor.getprevious()
+                        while (previous is not None and
+                               previous.tag == ancestor.tag):
+                            ancestor.getparent().remove(previous)
+                            previous = ancestor.getprevious()
+                    tree, skeleton = Introspect.recordSkeleton(record,
+                                                               ancestors)
                 else:
-                    ISOutput = response.text
-                    response.close()
-
-                self.output_etree.append(etree.fromstring(ISOutput))
+                    del skeleton[:]
+                # The parser reads ahead, so later records may already be
+                # in the parsed document: render the record from the
+                # skeleton document instead.
+                skeleton.append(record)
+                yield tree
+        except etree.XMLSyntaxError as inst:
+            raise IntrospectError("ERROR: parsing %s failed \n%s" %
+                                  (self.filename, inst))
 
-                if 'Snh_PageReq?x=' in path:
+    @staticmethod
+    def recordSkeleton(record, ancestors):
+        """ new document made of record's containers with the fields they
+            had before it, e.g. the table header of a route. Returns the
+            document and the element the record goes into. """
+        top = None
+        chain = ancestors[::-1] + [record]
+        for i, node in enumerate(chain[:-1]):
+            child = chain[i + 1]
+            node_copy = etree.Element(node.tag, dict(node.attrib))
+            for sibling in node:
+                if sibling is child:
+                    break
+                if sibling.tag != child.tag:
+                    node_copy.append(copy.deepcopy(sibling))
+            if top is None:
+                top = node_copy
+            else:
+                parent.append(node_copy)
+            parent = node_copy
+        return etree.ElementTree(top), parent
+
+    def prefetch_pages(self, path):
+        """ iter_pages() run by a background thread, which fetches the
+            next page while the current one is rendered. At most
+            'prefetch' parsed pages are queued ahead of the renderer. """
+        pages = queue.Queue(maxsize=prefetch)
+        stop = threading.Event()
+
+        def producer():
+            try:
+                for tree in self.iter_pages(path):
+                    pages.put((tree, None))
+                    if stop.is_set():
+                        return
+                pages.put((None, None))
+            except BaseException as e:
+                pages.put((None, e))
+
+        worker = threading.Thread(target=producer)
+        worker.daemon = True
+        worker.start()
+        try:
+            while True:
+                tree, error = pages.get()
+                if error is not None:
+                    raise error
+                if tree is None:
                     break
+                yield tree
+        finally:
+            # unblock the producer if rendering stopped early
+            stop.set()
+            while worker.is_alive():
+                try:
+                    pages.get(timeout=0.1)
+                except queue.Empty:
+                    pass
 
-                # some routes output may be paginated
-                pagination_path = "//Pagination/req/PageReqData"
-                pagination = self.output_etree[-1].xpath(pagination_path)
-                if len(pagination):
-                    if (pagination[0].find("next_page").text is not None):
-                        all = pagination[0].find("all").text
-                        if(all is not None):
-                            path = 'Snh_PageReq?x=' + all
-                            self.output_etree = []
-                            continue
-                        else:
-                            print("Warning: all page in pagination is empty!")
-                            break
-                    else:
-                        break
+    def iter_pages(self, path, stream=False):
+        """ generator yielding introspect output one page at a time """
 
-                next_batch = self.output_etree[-1].xpath("//next_batch")
+        # load xml output from given file
+        if self.filename and stream and path.split('?')[0] in RecordTags:
+            for tree in self.iter_records(RecordTags[path.split('?')[0]]):
+                yield tree
+            return
+        if self.filename:
+            try:
+                sys.stderr.write("Loadding from introspect xml %s\n" %
+                         self.filename)
+                if profile:
+                    tree = profile.timed('parse', etree.parse)(self.filename)
+                else:
+                    tree = etree.parse(self.filename)
+            except Exception as inst:
+                raise IntrospectError("ERROR: parsing %s failed \n%s" %
+                                      (self.filename, inst))
+            if debug: etree.dump(tree.getroot())
+            yield tree
+            return
 
-                if not len(next_batch):
-                    break
+        while path:
+            tree = self.parse_page(self.fetch(path))
+            if debug: etree.dump(tree)
+            keep, path = Introspect.nextPage(path, tree)
+            if keep:
+                yield tree
+        if debug: print("instrosepct get completes\n")
 
-                if (next_batch[0].text and next_batch[0].attrib['link']):
-                    path = 'Snh_' + next_batch[0].attrib['link'] + \
-                            '?x=' + next_batch[0].text
+    @staticmethod
+    def nextPage(path, tree):
+        """ follow the pagination of the page 'tree' fetched from 'path'.
+            Returns whether the page is part of the output, and the path
+            of the next page or None after the last page. """
+        if 'Snh_PageReq?x=' in path:
+            return True, None
+
+        # some routes output may be paginated
+        pagination_path = "//Pagination/req/PageReqData"
+        pagination = compile_xpath(pagination_path)(tree)
+        if len(pagination):
+            if (pagination[0].find("next_page").text is not None):
+                all = pagination[0].find("all").text
+                if(all is not None):
+                    # the "all" page supersedes this first page
+                    return False, 'Snh_PageReq?x=' + all
                 else:
-                    break
-                if debug: print("instrosepct get completes\n")
-        if debug:
-            for tree in self.output_etree:
-                etree.dump(tree)
+                    print("Warning: all page in pagination is empty!")
+            return True, None
+
+        next_batch = compile_xpath("//next_batch")(tree)
+        if (len(next_batch) and next_batch[0].text and
+                next_batch[0].attrib['link']):
+            return True, 'Snh_' + next_batch[0].attrib['link'] + \
+                    '?x=' + next_batch[0].text
+        return True, None
+
+    def parse_page(self, page):
+        """ parse one introspect page """
+        return etree.fromstring(page)
+
+    def fetch(self, path):
+        """ retrieve one introspect page """
+        if self.archive:
+            if debug: print("DEBUG: replaying %s from %s" %
+                            (path, self.archive.filename))
+            return self.archive.get(path)
+        ISOutput = self.download(path)
+        if capture:
+            capture.add(path, ISOutput)
+        return ISOutput
+
+    def url(self, path):
+        url = self.host_url + path.replace(' ', '%20')
+        if proxy and token:
+            url = proxy + "/forward-proxy?" + urlencode({'proxyURL': url})
+        return url
+
+    def cpu_load(self):
+        """ one minute load average per cpu of the host, None if unknown """
+        try:
+            response = self.send(self.url('Snh_CpuLoadInfoReq'))
+            response.close()
+            if response.status_code >= 400:
+                return None
+            tree = etree.fromstring(decode_content(
+                response.wire, response.headers.get('Content-Encoding')))
+            cpus = float(compile_xpath('//CpuLoadInfo/num_cpu/text()')(tree)[0])
+            load = float(compile_xpath('//one_min_avg/text()')(tree)[0])
+            return load / cpus
+        except Exception:
+            return None
+
+    def send(self, url):
+        """ GET url with requests, or the asyncio engine if set. The body
+            is read as received, still compressed, into response.wire """
+        if engine:
+            headers = {'X-Auth-Token': token} if proxy and token else None
+            response = engine.get(url, headers)
+            response.wire = response.content
+        else:
+            response = self.connect().get(url, stream=True)
+            try:
+                response.wire = response.raw.read(decode_content=False)
+            except requests.packages.urllib3.exceptions.HTTPError as e:
+                raise requests.exceptions.ConnectionError(e)
+        return response
+
+    def transferred(self, url, wire, size, encoding):
+        """ called for each downloaded page of 'size' bytes, received as
+            'wire' bytes with Content-Encoding 'encoding' """
+        if debug: print("DEBUG: %d bytes on the wire, %d decoded (%s) for "
+                        "url %s" % (wire, size, encoding, url))
+
+    def download(self, path):
+        url = self.url(path)
+        if cache:
+            ISOutput = cache.get(url)
+            if ISOutput is not None:
+                return ISOutput
+        if debug: print("DEBUG: retrieving url " + url)
+        try:
+            if scheduler:
+                response = scheduler.request(
+                    self.host_url, path, lambda: self.send(url),
+                    self.cpu_load)
+            else:
+                response = self.send(url)
+        except IntrospectError:
+            raise
+        except requests.exceptions.RequestException as e:
+            raise IntrospectError('Failed to reach destination'
+                                  '\nURL: %s\nReason: %s' % (url, e))
+        response.close()
+        encoding = response.headers.get('Content-Encoding', 'identity')
+        ISOutput = decode_content(response.wire, encoding, url)
+        if response.status_code >= 400:
+            raise IntrospectError('The server couldn\'t fulfill the request.'
+                                  '\nURL: %s\nError code: %s\nError text: %s'
+                                  % (url, response.status_code,
+                                     ISOutput.decode('utf-8', 'replace')))
+        self.transferred(url, len(response.wire), len(ISOutput), encoding)
+        if cache:
+            cache.put(url, ISOutput)
+        return ISOutput
 
     def printTbl(self, xpathExpr, max_width=Default_Max_Width, *args):
         """ print introspect output in a table.
             args lists interested fields. """
-        items = []
+        self.renderTbl(xpathExpr, max_width, args, None)
+
+    def streamTbl(self, xpathExpr, max_width, sample, *args):
+        """ print introspect output in a table written row by row, with
+            columns max_width wide, or sized from the first 'sample' rows
+            when max_width is None. args lists interested fields. """
+        self.renderTbl(xpathExpr, max_width, args, sample)
+
+    def renderTbl(self, xpathExpr, max_width, columns, sample):
+        tbl = None
+        for tree in self.output_etree:
+            for entry in compile_xpath(xpathExpr)(tree):
+                if tbl is None:
+                    fields = Introspect.tblFields(entry, columns)
+                    if self.tables is not None:
+                        tbl = []
+                        self.tables.append((fields, tbl))
+                        add_row = tbl.append
+                    elif sample is not None:
+                        tbl = StreamTable(fields, max_width, sample)
+                        add_row = tbl.add_row
+                    else:
+                        tbl = Introspect.newTbl(fields, max_width)
+                        add_row = tbl.add_row
+                add_row(Introspect.tblRow(entry, fields))
+        if tbl is None or self.tables is not None:
+            return
+        if sample is not None:
+            tbl.close()
+        else:
+            print(tbl)
+
+    def printRows(self, fields, rows, max_width=Default_Max_Width):
+        """ print rows built by the caller in a table """
+        if self.tables is not None:
+            self.tables.append((fields, rows))
+            return
+        tbl = Introspect.newTbl(fields, max_width)
+        for row in rows:
+            tbl.add_row(row)
+        print(tbl)
+
+    def printRecords(self, xpathExpr, format, columns):
+        """ print one json/ndjson/csv record per matched element.
+            columns lists interested fields, all fields if empty. """
+        writer = RecordWriter(format, self.records)
         for tree in self.output_etree:
-            items = items + tree.xpath(xpathExpr)
-        if len(items):
-            Introspect.dumpTbl(items, max_width, args)
+            for entry in compile_xpath(xpathExpr)(tree):
+                if format == 'csv':
+                    if not writer.count:
+                        fields = Introspect.tblFields(entry, columns)
+                    writer.write(Introspect.tblRow(entry, fields), fields)
+                    continue
+                record = Introspect.elementToDict(entry)
+                if len(columns):
+                    record = OrderedDict((f, record.get(f, None))
+                                         for f in columns)
+                writer.write(record)
+        writer.close()
 
     def printText(self, xpathExpr):
         """ print introspect output in human readable text """
         for tree in self.output_etree:
-            for element in tree.xpath(xpathExpr):
+            for element in compile_xpath(xpathExpr)(tree):
                 print(Introspect.elementToStr('', element).rstrip())
 
     @staticmethod
@@ -150,30 +1143,69 @@ class Introspect:
         if not len(items):
             return
 
+        fields = Introspect.tblFields(items[0], columns)
+        tbl = Introspect.newTbl(fields, max_width)
+        for entry in items:
+            tbl.add_row(Introspect.tblRow(entry, fields))
+        print(tbl)
+
+    @staticmethod
+    def tblFields(entry, columns):
+        """ table fields: given columns or tags of the first entry """
         if len(columns):
-            fields = columns
-        else:
-            fields = [ e.tag for e in items[0] if e.tag != "more"]
+            return columns
+        return [ e.tag for e in entry if e.tag != "more"]
 
+    @staticmethod
+    def newTbl(fields, max_width):
         tbl = PrettyTable(fields)
         tbl.align = 'l'
         tbl.max_width = max_width
-        for entry in items:
-            row = []
-            for field in fields:
-                f = entry.find(field)
-                if f is not None:
-                    if f.text:
-                        row.append(f.text)
-                    elif list(f):
-                        for e in f:
-                            row.append(Introspect.elementToStr('', e).rstrip())
-                    else:
-                        row.append("n/a")
+        return tbl
+
+    @staticmethod
+    def tblRow(entry, fields):
+        """ build one table row out of entry """
+        row = []
+        for field in fields:
+            f = entry.find(field)
+            if f is not None:
+                if f.text:
+                    row.append(f.text)
+                elif list(f):
+                    for e in f:
+                        row.append(Introspect.elementToStr('', e).rstrip())
                 else:
-                    row.append("-")
-            tbl.add_row(row)
-        print(tbl)
+                    row.append("n/a")
+            else:
+                row.append("-")
+        return row
+
+    @staticmethod
+    def elementToDict(etreenode):
+        """ convert etreenode sub-tree into json friendly objects: structs
+            into dicts, sandesh lists into lists and leaves into text """
+        children = [e for e in etreenode if e.tag != 'more']
+        if etreenode.get('type') == 'list':
+            if not len(children):
+                return []
+            return [Introspect.elementToDict(e) for e in children[0]]
+        if etreenode.get('type') == 'struct' and len(children) == 1:
+            return Introspect.elementToDict(children[0])
+        if not len(children):
+            return etreenode.text or ''
+        return OrderedDict((e.tag, Introspect.elementToDict(e))
+                           for e in children)
+
+    @staticmethod
+    def fieldStr(etreenode, field):
+        """ text of a leaf field, or of the elements of a list field """
+        f = etreenode.find(field)
+        if f is None:
+            return ''
+        if f.get('type') == 'list':
+            return ' '.join(compile_xpath('list/element/text()')(f))
+        return f.text or ''
 
     @staticmethod
     def elementToStr(indent, etreenode):
@@ -214,7 +1246,7 @@ class Introspect:
         now = datetime.utcnow()
 
         path_modified = path.find("last_modified").text
-        t1 = datetime.strptime(path_modified, '%Y-%b-%d %H:%M:%S.%f')
+        t1 = parse_timestamp(path_modified)
         path_age = str(now - t1).replace(',', '')
         path_proto = path.find("protocol").text
         path_source = path.find("source").text
@@ -224,9 +1256,12 @@ class Introspect:
         path_label = path.find("label").text
         path_vn = path.find("origin_vn").text
         path_pri_tbl = path.find("primary_table").text
-        path_vn_path = str(path.xpath("origin_vn_path/list/element/text()"))
-        path_encap = str(path.xpath("tunnel_encap/list/element/text()"))
-        path_comm = str(path.xpath("communities/list/element/text()"))
+        path_vn_path = str(
+            compile_xpath("origin_vn_path/list/element/text()")(path))
+        path_encap = str(
+            compile_xpath("tunnel_encap/list/element/text()")(path))
+        path_comm = str(
+            compile_xpath("communities/list/element/text()")(path))
         path_sqn = path.find("sequence_no").text
         path_flags = path.find("flags").text
 
@@ -252,140 +1287,232 @@ class Introspect:
 
         prefix = route.find("prefix").text
         prefix_modified = route.find("last_modified").text
-        t1 = datetime.strptime(prefix_modified, '%Y-%b-%d %H:%M:%S.%f')
+        t1 = parse_timestamp(prefix_modified)
         prefix_age = str(now - t1).replace(',', '')
 
         route_info += "%s%s, age: %s, last_modified: %s" % \
                     (indent, prefix, prefix_age, prefix_modified)
 
-        for path in route.xpath('.//ShowRoutePath'):
+        for path in compile_xpath('.//ShowRoutePath')(route):
             route_info += "\n" + Introspect.pathToStr(indent*2, path, mode)
 
         return route_info.rstrip()
 
-    def showRoute_VR(self, xpathExpr, family, address, mode):
+    def showRoute_VR(self, xpathExpr, family, address, mode, format='text'):
         """ method to show route output from vrouter intropsect """
-        indent = ' ' * 4
-
-        ADDR_INET4 = 4
-        ADDR_INET6 = 6
-        ADDR_NONE = 0
+        writer = (None if format == 'text' else
+                  RecordWriter(format, self.records))
+        if ((family == 'inet' and is_ipv4(address)) or
+                (family == 'inet6' and is_ipv6(address))):
+            # show the longest match and the routes covering it. Only
+            # copies of the covering routes are kept, so that each page
+            # is released once scanned.
+            index = PrefixIndex(family)
+            addr = index.address(address)
+            covering = {}
+            for tree in self.output_etree:
+                for route in compile_xpath(xpathExpr)(tree):
+                    prefix = route.find("src_ip").text + '/' + \
+                                route.find("src_plen").text
+                    plen = index.covers(prefix, addr)
+                    if plen is not None:
+                        covering[plen] = copy.deepcopy(route)
+            routes = [covering[plen] for plen in sorted(covering)]
+            for route in routes:
+                if writer is not None:
+                    Introspect.writeRoute_VR(writer, route, family,
+                                             route is routes[-1])
+                else:
+                    print(Introspect.routeToStr_VR(route, family, mode,
+                                                   route is routes[-1]))
+        else:
+            for tree in self.output_etree:
+                for route in compile_xpath(xpathExpr)(tree):
+                    if writer is not None:
+                        Introspect.writeRoute_VR(writer, route, family)
+                    else:
+                        print(Introspect.routeToStr_VR(route, family, mode))
+        if writer is not None:
+            writer.close()
 
-        addr_type = ADDR_NONE
-        if is_ipv4(address):
-            addr_type = ADDR_INET4
-        elif is_ipv6(address):
-            addr_type = ADDR_INET6
+    @staticmethod
+    def writeRoute_VR(writer, route, family, best=False):
+        """ write one vrouter route as a record, or one csv row per path """
+        if writer.format != 'csv':
+            record = Introspect.elementToDict(route)
+            if best:
+                record['longest_match'] = True
+            writer.write(record)
+            return
 
+        if 'inet' in family:
+            prefix = route.find("src_ip").text + '/' + \
+                        route.find("src_plen").text
+        else:
+            prefix = route.find("mac").text
+        fields = ['prefix', 'peer', 'preference', 'nh_type', 'nh_index',
+                  'itf', 'mac', 'label', 'active_label', 'vxlan_id',
+                  'dest_vn_list']
+        for path in compile_xpath(".//PathSandeshData")(route):
+            nh = path.find("nh/NhSandeshData")
+            pref = path.find("path_preference_data/"
+                             "PathPreferenceSandeshData")
+            row = [prefix, Introspect.fieldStr(path, 'peer'),
+                   Introspect.fieldStr(pref, 'preference')
+                        if pref is not None else '']
+            row += [Introspect.fieldStr(nh, f) if nh is not None else ''
+                    for f in ['type', 'nh_index', 'itf', 'mac']]
+            row += [Introspect.fieldStr(path, f)
+                    for f in ['label', 'active_label', 'vxlan_id',
+                              'dest_vn_list']]
+            writer.write(row, fields)
+
+    def routeIndex_VR(self, xpathExpr, family):
+        """ index of the fetched routes for address lookups. Each route is
+            reduced to a (prefix, nh_type, label, interface, peer) tuple
+            of its first path, so pages are released once indexed. """
+        if family == 'layer2':
+            index = {}
+        else:
+            index = PrefixIndex(family)
         for tree in self.output_etree:
-            for route in tree.xpath(xpathExpr):
-                if 'inet' in family:
+            for route in compile_xpath(xpathExpr)(tree):
+                if family == 'layer2':
+                    prefix = route.find("mac").text
+                else:
                     prefix = route.find("src_ip").text + '/' + \
                                 route.find("src_plen").text
+                nh_type = label = itf = peer = '-'
+                path = route.find(".//PathSandeshData")
+                if path is not None:
+                    peer = path.find("peer").text
+                    label = path.find("label").text
+                    nh = path.find("nh/NhSandeshData")
+                    if nh is not None:
+                        nh_type = nh.find("type").text
+                        if nh_type == "tunnel":
+                            itf = "%s dip:%s" % (nh.find("tunnel_type").text,
+                                                 nh.find("dip").text)
+                        elif nh.find("itf") is not None:
+                            itf = nh.find("itf").text
+                        elif 'Composite' in str(nh_type):
+                            itf = ' '.join(compile_xpath(".//itf/text()")(nh))
+                entry = (prefix, nh_type, label, itf, peer)
+                if family == 'layer2':
+                    index[normalize_mac(prefix)] = entry
                 else:
-                    prefix = route.find("mac").text
-
-                if family == 'inet' and addr_type == ADDR_INET4:
-                    if not addressInNetwork(address, prefix):
-                        if debug: print("DEBUG: skipping " + prefix)
-                        continue
-                elif family == 'inet6' and addr_type == ADDR_INET6:
-                    if not addressInNetwork6(address, prefix):
-                        if debug: print("DEBUG: skipping " + prefix)
-                        continue
-
-                if mode == "raw":
-                    print(Introspect.elementToStr('', route).rstrip())
-                    continue
+                    index.insert(prefix, entry)
+        return index
 
-                output = prefix + "\n"
+    @staticmethod
+    def routeToStr_VR(route, family, mode, best=False):
+        """ convert one vrouter route into string """
+        indent = ' ' * 4
 
-                for path in route.xpath(".//PathSandeshData"):
-                    nh = path.xpath("nh/NhSandeshData")[0]
+        if mode == "raw":
+            return Introspect.elementToStr('', route).rstrip()
 
-                    peer = path.find("peer").text
-                    pref = path.xpath("path_preference_data/"
-                                      "PathPreferenceSandeshData/"
-                                      "preference")[0].text
-
-                    path_info = "%s[%s] pref:%s\n" % (indent, peer, pref)
-
-                    path_info += indent + ' '
-                    nh_type = nh.find('type').text
-                    if nh_type == "interface":
-                        mac = nh.find('mac').text
-                        itf = nh.find("itf").text
-                        label = path.find("label").text
-                        path_info += ("to %s via %s, assigned_label:%s, "
-                                        % (mac, itf, label))
-
-                    elif nh_type == "tunnel":
-                        tunnel_type = nh.find("tunnel_type").text
-                        dip = nh.find("dip").text
-                        sip = nh.find("sip").text
-                        label = path.find("label").text
-                        if nh.find('mac') is not None:
-                            mac = nh.find('mac').text
-                            path_info += ("to %s via %s dip:%s "
-                                          "sip:%s label:%s, "
-                                          % (mac, tunnel_type, dip,
-                                             sip, label))
-                        else:
-                            path_info += ("via %s dip:%s sip:%s label:%s, "
-                                          % (tunnel_type, dip, sip, label))
-
-                    elif nh_type == "receive":
-                        itf = nh.find("itf").text
-                        path_info += "via %s, " % (itf)
-
-                    elif nh_type == "arp":
-                        mac = nh.find('mac').text
-                        itf = nh.find("itf").text
-                        path_info += "via %s, " % (mac)
-
-                    elif 'Composite' in str(nh_type):
-                        comp_nh = str(nh.xpath(".//itf/text()"))
-                        path_info += "via %s, " % (comp_nh)
-
-                    elif 'vlan' in str(nh_type):
-                        mac = nh.find('mac').text
-                        itf = nh.find("itf").text
-                        path_info += "to %s via %s, " % (mac, itf)
-
-                    nh_index = nh.find("nh_index").text
-                    if nh.find("policy") is not None:
-                        policy = nh.find("policy").text
-                    else:
-                        policy = ''
-                    active_label = path.find("active_label").text
-                    vxlan_id = path.find("vxlan_id").text
-                    path_info += ("nh_index:%s , nh_type:%s, nh_policy:%s, "
-                                  "active_label:%s, vxlan_id:%s" %
-                                 (nh_index, nh_type, policy,
-                                  active_label, vxlan_id))
-
-                    if mode == "detail":
-                        path_info += "\n"
-                        path_info += indent + ' dest_vn:' + \
-                            str(path.xpath("dest_vn_list/list/element/text()"))
-                        path_info += ', sg:' + \
-                            str(path.xpath("sg_list/list/element/text()"))
-                        path_info += ', communities:' +  \
-                            str(path.xpath("communities/list/element/text()"))
-                    output += path_info + "\n"
-
-                print(output.rstrip())
-
-    def showRoute_CTR(self, last, mode):
+        if 'inet' in family:
+            prefix = route.find("src_ip").text + '/' + \
+                        route.find("src_plen").text
+        else:
+            prefix = route.find("mac").text
+
+        if best:
+            prefix += " (longest match)"
+
+        output = prefix + "\n"
+
+        for path in compile_xpath(".//PathSandeshData")(route):
+            nh = compile_xpath("nh/NhSandeshData")(path)[0]
+
+            peer = path.find("peer").text
+            pref = compile_xpath("path_preference_data/"
+                                 "PathPreferenceSandeshData/"
+                                 "preference")(path)[0].text
+
+            path_info = "%s[%s] pref:%s\n" % (indent, peer, pref)
+
+            path_info += indent + ' '
+            nh_type = nh.find('type').text
+            if nh_type == "interface":
+                mac = nh.find('mac').text
+                itf = nh.find("itf").text
+                label = path.find("label").text
+                path_info += ("to %s via %s, assigned_label:%s, "
+                                % (mac, itf, label))
+
+            elif nh_type == "tunnel":
+                tunnel_type = nh.find("tunnel_type").text
+                dip = nh.find("dip").text
+                sip = nh.find("sip").text
+                label = path.find("label").text
+                if nh.find('mac') is not None:
+                    mac = nh.find('mac').text
+                    path_info += ("to %s via %s dip:%s "
+                                  "sip:%s label:%s, "
+                                  % (mac, tunnel_type, dip,
+                                     sip, label))
+                else:
+                    path_info += ("via %s dip:%s sip:%s label:%s, "
+                                  % (tunnel_type, dip, sip, label))
+
+            elif nh_type == "receive":
+                itf = nh.find("itf").text
+                path_info += "via %s, " % (itf)
+
+            elif nh_type == "arp":
+                mac = nh.find('mac').text
+                itf = nh.find("itf").text
+                path_info += "via %s, " % (mac)
+
+            elif 'Composite' in str(nh_type):
+                comp_nh = str(compile_xpath(".//itf/text()")(nh))
+                path_info += "via %s, " % (comp_nh)
+
+            elif 'vlan' in str(nh_type):
+                mac = nh.find('mac').text
+                itf = nh.find("itf").text
+                path_info += "to %s via %s, " % (mac, itf)
+
+            nh_index = nh.find("nh_index").text
+            if nh.find("policy") is not None:
+                policy = nh.find("policy").text
+            else:
+                policy = ''
+            active_label = path.find("active_label").text
+            vxlan_id = path.find("vxlan_id").text
+            path_info += ("nh_index:%s , nh_type:%s, nh_policy:%s, "
+                          "active_label:%s, vxlan_id:%s" %
+                         (nh_index, nh_type, policy,
+                          active_label, vxlan_id))
+
+            if mode == "detail":
+                path_info += "\n"
+                dest_vn = compile_xpath("dest_vn_list/list/element/text()")
+                path_info += indent + ' dest_vn:' + str(dest_vn(path))
+                path_info += ', sg:' + \
+                    str(compile_xpath("sg_list/list/element/text()")(path))
+                path_info += ', communities:' +  \
+                    str(compile_xpath("communities/list/element/text()")(path))
+            output += path_info + "\n"
+
+        return output.rstrip()
+
+    def showRoute_CTR(self, last, mode, format='text'):
         """ show route output from control node intropsect """
         indent = ' ' * 4
+        writer = (None if format == 'text' else
+                  RecordWriter(format, self.records))
         now = datetime.utcnow()
+        # routes and paths modified before cutoff are filtered out
+        cutoff = now - timedelta(seconds=last) if last else None
         printedTbl = {}
         xpath_tbl = '//ShowRouteTable'
         xpath_rt = './/ShowRoute'
         xpath_pth = './/ShowRoutePath'
         for tree in self.output_etree:
-            for table in tree.xpath(xpath_tbl):
+            for table in compile_xpath(xpath_tbl)(tree):
                 tbl_name = table.find('routing_table_name').text
                 prefix_count = table.find('prefixes').text
                 tot_path_count = table.find('paths').text
@@ -393,7 +1520,7 @@ class Introspect:
                 sec_path_count = table.find('secondary_paths').text
                 ifs_path_count = table.find('infeasible_paths').text
 
-                if not(tbl_name in printedTbl):
+                if not(tbl_name in printedTbl) and writer is None:
                     print(("\n%s: %s destinations, %s routes "
                             "(%s primary, %s secondary, %s infeasible)"
                             % (tbl_name, prefix_count, tot_path_count,
@@ -403,31 +1530,63 @@ class Introspect:
 
 
                 # start processing each route
-                for route in table.xpath(xpath_rt):
-                    paths = route.xpath(xpath_pth)
+                for route in compile_xpath(xpath_rt)(table):
+                    paths = compile_xpath(xpath_pth)(route)
                     if not (len(paths)):
                         continue
-                    prefix = route.find("prefix").text
                     prefix_modified = route.find("last_modified").text
-                    t1 = datetime.strptime(prefix_modified,
-                                           '%Y-%b-%d %H:%M:%S.%f')
-                    prefix_age = str(now - t1).replace(',', '')
+                    t1 = parse_timestamp(prefix_modified)
+                    if cutoff and t1 < cutoff:
+                        # only recent paths of this route are shown
+                        paths = [path for path in paths if not
+                                 parse_timestamp(
+                                    path.find("last_modified").text) < cutoff]
+                        if not len(paths):
+                            continue
+                        recent = True
+                    else:
+                        recent = False
+                    prefix = route.find("prefix").text
+
+                    if writer is not None:
+                        Introspect.writeRoute_CTR(writer, tbl_name,
+                                                  route, paths)
+                        continue
 
-                    if (last and (now - t1).total_seconds() > last):
+                    prefix_age = str(now - t1).replace(',', '')
+                    if recent:
                         for path in paths:
-                            path_modified = path.find("last_modified").text
-                            t1 = datetime.strptime(path_modified,
-                                                   '%Y-%b-%d %H:%M:%S.%f')
-                            path_age = str(now - t1).replace(',', '')
-                            if not ((now - t1).total_seconds() > last) :
-                                print(("\n%s, age: %s, last_modified: %s" %
-                                        (prefix, prefix_age, prefix_modified)))
-                                print(Introspect.pathToStr(indent, path, mode))
+                            print(("\n%s, age: %s, last_modified: %s" %
+                                    (prefix, prefix_age, prefix_modified)))
+                            print(Introspect.pathToStr(indent, path, mode))
                     else:
                         print(("\n%s, age: %s, last_modified: %s" %
                                 (prefix, prefix_age, prefix_modified)))
                         for path in paths:
                             print(Introspect.pathToStr(indent, path, mode))
+        if writer is not None:
+            writer.close()
+
+    @staticmethod
+    def writeRoute_CTR(writer, table, route, paths):
+        """ write one control node route as a record, or one csv row per
+            path """
+        prefix = route.find("prefix").text
+        if writer.format != 'csv':
+            writer.write(OrderedDict([
+                ('table', table),
+                ('prefix', prefix),
+                ('last_modified', route.find("last_modified").text),
+                ('paths', [Introspect.elementToDict(p) for p in paths])]))
+            return
+
+        fields = ['protocol', 'source', 'last_modified', 'local_preference',
+                  'next_hop', 'label', 'as_path', 'origin_vn',
+                  'primary_table', 'tunnel_encap', 'communities']
+        for path in paths:
+            writer.write([table, prefix] +
+                         [Introspect.fieldStr(path, f) for f in fields],
+                         ['table', 'prefix'] + fields)
 
     def showSCRoute(self, xpathExpr):
 
@@ -444,12 +1603,10 @@ class Introspect:
                   'more_specifics',
                   'ext_connecting_rt']
 
-        tbl = PrettyTable(fields)
-        tbl.align = 'l'
-
+        rows = []
         # start building the table
         for tree in self.output_etree:
-            for sc in tree.xpath(xpathExpr):
+            for sc in compile_xpath(xpathExpr)(tree):
                 row = []
                 for field in fields[0:2]:
                     f = sc.find(field)
@@ -465,12 +1622,12 @@ class Introspect:
 
                 sc_xpath = ('./connected_route/ConnectedRouteInfo'
                             '/service_chain_addr')
-                service_chain_addr = sc.xpath(sc_xpath)[0]
+                service_chain_addr = compile_xpath(sc_xpath)(sc)[0]
                 row.append(Introspect.elementToStr('', service_chain_addr).rstrip())
 
                 specifics = ''
                 spec_xpath = './more_specifics/list/PrefixToRouteListInfo'
-                PrefixToRouteListInfo = sc.xpath(spec_xpath)
+                PrefixToRouteListInfo = compile_xpath(spec_xpath)(sc)
                 for p in PrefixToRouteListInfo:
                     specifics += ("prefix: %s, aggregate: %s\n" %
                                 (p.find('prefix').text,
@@ -479,13 +1636,20 @@ class Introspect:
 
                 ext_rt = ''
                 ext_xpath = './ext_connecting_rt_info_list//ext_rt_prefix'
-                ext_rt_prefix_list = sc.xpath(ext_xpath)
+                ext_rt_prefix_list = compile_xpath(ext_xpath)(sc)
                 for p in ext_rt_prefix_list:
                     ext_rt += p.text + "\n"
                 row.append(ext_rt.rstrip())
 
-                tbl.add_row(row)
+                rows.append(row)
 
+        if self.tables is not None:
+            self.tables.append((fields, rows))
+            return
+        tbl = PrettyTable(fields)
+        tbl.align = 'l'
+        for row in rows:
+            tbl.add_row(row)
         print(tbl)
 
     def showSCRouteDetail(self, xpathExpr):
@@ -497,7 +1661,7 @@ class Introspect:
                   'dest_rt_instance', 'state']
         for tree in self.output_etree:
 
-            for sc in tree.xpath(xpathExpr):
+            for sc in compile_xpath(xpathExpr)(tree):
 
                 for field in fields:
                     print("%s: %s" % (field, sc.find(field).text))
@@ -506,14 +1670,14 @@ class Introspect:
                 sc_xpath = ('./connected_route/ConnectedRouteInfo'
                             '/service_chain_addr')
                 print(("%sservice_chain_addr: %s" %
-                       (indent, sc.xpath(sc_xpath)[0].text)))
-                for route in sc.xpath('./connected_route//ShowRoute'):
+                       (indent, compile_xpath(sc_xpath)(sc)[0].text)))
+                for route in compile_xpath('./connected_route//ShowRoute')(sc):
                     print(Introspect.routeToStr(indent, route, 'detail'))
 
                 print("more_specifics:")
                 specifics = ''
                 spec_xpath = './more_specifics/list/PrefixToRouteListInfo'
-                PrefixToRouteListInfo = sc.xpath(spec_xpath)
+                PrefixToRouteListInfo = compile_xpath(spec_xpath)(sc)
                 for p in PrefixToRouteListInfo:
                     specifics += ("%sprefix: %s, aggregate: %s\n" %
                                   (indent, p.find('prefix').text,
@@ -522,7 +1686,7 @@ class Introspect:
 
                 print("ext_connecting_rt_info_list:")
                 ext_xpath = './/ExtConnectRouteInfo/ext_rt_svc_rt/ShowRoute'
-                for route in sc.xpath(ext_xpath):
+                for route in compile_xpath(ext_xpath)(sc):
                     print(Introspect.routeToStr(indent, route, 'detail'))
 
                 print(("aggregate_enable:%s\n" %
@@ -533,12 +1697,26 @@ class Introspect:
             columns = []
         if not max_width:
             max_width = Default_Max_Width
+        collected = None
         for tree in self.output_etree:
-            for entry in tree.xpath(xpathExpr):
-                if format == 'table':
-                    print('ri_name: %s' % (entry.find('ri_name').text))
-                    Introspect.dumpTbl(entry.xpath("//StaticRouteInfo"),
-                                       max_width, columns)
+            for entry in compile_xpath(xpathExpr)(tree):
+                ri_name = entry.find('ri_name').text
+                if format == 'table' and self.tables is not None:
+                    # the routes of all routing instances in one table,
+                    # with an ri_name column instead of the ri_name lines
+                    for item in compile_xpath(".//StaticRouteInfo")(entry):
+                        if collected is None:
+                            fields = Introspect.tblFields(item, columns)
+                            collected = []
+                            self.tables.append((['ri_name'] + fields,
+                                                collected))
+                        collected.append([ri_name] +
+                                         Introspect.tblRow(item, fields))
+                elif format == 'table':
+                    print('ri_name: %s' % ri_name)
+                    Introspect.dumpTbl(
+                        compile_xpath(".//StaticRouteInfo")(entry),
+                        max_width, columns)
                 else:
                     print(Introspect.elementToStr('', entry))
 
@@ -577,13 +1755,22 @@ class CLI_basic(object):
 
     common_parser = argparse.ArgumentParser(add_help=False)
     common_parser.add_argument('-f', '--format',
-                               choices=['table', 'text'],
+                               choices=['table', 'text', 'json', 'ndjson',
+                                        'csv'],
                                default = 'table',
                                help='Output format.')
     common_parser.add_argument('-c', '--columns', nargs= '*',
                                help='Column(s) to include')
     common_parser.add_argument('--max_width', type=int,
                                help="Max width per column")
+    common_parser.add_argument('--stream', action="store_true",
+                               help="Print table rows as they arrive, with "
+                                    "columns --max_width wide, or sized from "
+                                    "the first %d rows" % Stream_Sample_Rows)
+    common_parser.add_argument('--watch', type=float, metavar='SECONDS',
+                               help="Poll every SECONDS and print only the "
+                                    "rows added (+), removed (-) or "
+                                    "changed (~)")
 
     def __init__(self, parser, host, port, filename):
 
@@ -618,15 +1805,33 @@ class CLI_basic(object):
                           help='UVE type name')
         subp.set_defaults(func=self.SnhUve)
 
+    def refresh(self):
+        """ forget the state kept across ist shell commands """
+        pass
+
+    def for_host(self, host):
+        """ copy of this CLI querying the same service on another host """
+        cli = copy.copy(self)
+        cli.IST = Introspect(host, self.IST.port, self.IST.filename)
+        cli.IST.archive = self.IST.archive
+        return cli
+
     def output_formatters(self, args, xpath, default_columns=[]):
         if args.format == 'text':
             self.IST.printText(xpath)
+        elif args.format in ['json', 'ndjson']:
+            self.IST.printRecords(xpath, args.format, args.columns or [])
+        elif args.format == 'csv':
+            self.IST.printRecords(xpath, args.format,
+                                  args.columns or default_columns)
         else:
             max_width = args.max_width or Default_Max_Width
-            if args.columns:
-                self.IST.printTbl(xpath, max_width, *args.columns)
+            columns = args.columns or default_columns
+            if args.stream:
+                self.IST.streamTbl(xpath, args.max_width, Stream_Sample_Rows,
+                                   *columns)
             else:
-                self.IST.printTbl(xpath, max_width, *default_columns)
+                self.IST.printTbl(xpath, max_width, *columns)
 
     def SnhNodeStatus(self, args):
         self.IST.get('Snh_SandeshUVECacheReq?tname=NodeStatus')
@@ -830,6 +2035,28 @@ class CLI_ctr(CLI_basic):
                               help="Route family(default='%(default)s')")
         subp.set_defaults(func=self.SnhShowRTable)
 
+        subp = rp.add_parser('churn',
+                             help='Show route tables with the highest '
+                                  'prefix/path change rate')
+        subp.add_argument('search', nargs='?', default='',
+                          help='Only watch matched tables')
+        subp.add_argument('--family', default='all',
+                          choices=['inet', 'inet6', 'evpn', 'ermvpn', 'all'],
+                          help="Route family(default='%(default)s')")
+        subp.add_argument('-i', '--interval', type=valid_period, default=5,
+                          help='Polling interval (e.g. 5s, 1m), 5s by default')
+        subp.add_argument('-w', '--window', type=positive_int, default=12,
+                          help='Polls kept per table for min/avg/max '
+                               "(default=%(default)s)")
+        subp.add_argument('-n', '--top', type=positive_int, default=10,
+                          help="Tables shown per poll (default=%(default)s)")
+        subp.add_argument('--count', type=int, default=0,
+                          help='Stop after COUNT reports, run until Ctrl-C '
+                               'by default')
+        subp.add_argument('--max_width', type=int,
+                          help="Max width per column")
+        subp.set_defaults(func=self.SnhRouteChurn)
+
         subp = rp.add_parser('show', help='Show route')
         subp.add_argument('prefix', nargs='?', default='',
                           help='Show routes matching given prefix')
@@ -859,6 +2086,9 @@ class CLI_ctr(CLI_basic):
                           help='Shows more specific routes')
         subp.add_argument('--shorter_match', action="store_true",
                           help='Shows less specific routes')
+        subp.add_argument('--format', default='text',
+                          choices=['text', 'json', 'ndjson', 'csv'],
+                          help='Output format.')
         subp.set_defaults(func=self.SnhShowRoute)
 
         subp = rp.add_parser('static', parents = [self.common_parser],
@@ -1134,13 +2364,13 @@ class CLI_ctr(CLI_basic):
             xpath = '//IFMapNodeShowInfo'
             default_columns = ['node_name', 'interests', 'advertised',
                                'dbentryflags', 'last_modified']
-        self.IST.get(path)
+        self.IST.get(path, stream=True)
         self.output_formatters(args, xpath, default_columns)
 
     def SnhIFMapLinkShow(self, args):
         path = ('Snh_IFMapLinkTableShowReq?search_string=%s&metadata=%s' %
                 (args.search, args.metadata))
-        self.IST.get(path)
+        self.IST.get(path, stream=True)
         xpath = "//IFMapLinkShowInfo"
         self.output_formatters(args, xpath)
 
@@ -1217,7 +2447,8 @@ class CLI_ctr(CLI_basic):
         self.output_formatters(args, '//ShowXmppConnection')
 
     def SnhBgpNeighbor(self, args):
-        self.IST.get('Snh_BgpNeighborReq?search_string=' + args.search)
+        self.IST.get('Snh_BgpNeighborReq?search_string=' + args.search,
+                     stream=True)
 
         if args.type:
             xpath = "//BgpNeighborResp[encoding='" + args.type + "']"
@@ -1231,7 +2462,8 @@ class CLI_ctr(CLI_basic):
         self.output_formatters(args, xpath, default_columns)
 
     def SnhRoutingInstance(self, args):
-        self.IST.get('Snh_ShowRoutingInstanceReq?search_string=' + args.search)
+        self.IST.get('Snh_ShowRoutingInstanceReq?search_string=' + args.search,
+                     stream=True)
         xpath = "//ShowRoutingInstance"
 
         default_columns = ["name", "vn_index", "vxlan_id", "import_target",
@@ -1241,7 +2473,13 @@ class CLI_ctr(CLI_basic):
 
 
     def SnhShowRouteSummary(self, args):
-        self.IST.get('Snh_ShowRouteSummaryReq?search_string=' + args.search)
+        params = OrderedDict([('search_string', args.search)])
+        if args.family != 'all':
+            # table names end with <family>.0
+            push_search(args.family + '.0', params,
+                        [('search_string', lambda s: True)])
+        self.IST.get(request_path('Snh_ShowRouteSummaryReq', params),
+                     stream=True)
         xpath = "//ShowRouteTableSummary"
         if args.family != 'all':
             xpath += "[contains(name, '%s.0')]" % args.family
@@ -1255,7 +2493,11 @@ class CLI_ctr(CLI_basic):
         self.output_formatters(args, xpath, default_columns)
 
     def SnhShowRTable(self, args):
-        self.IST.get('Snh_ShowRouteSummaryReq?search_string=' + args.search)
+        params = OrderedDict([('search_string', args.search)])
+        if args.family != 'all':
+            push_search(args.family + '.0', params,
+                        [('search_string', lambda s: True)])
+        self.IST.get(request_path('Snh_ShowRouteSummaryReq', params))
         xpath = "//ShowRouteTableSummary/name"
         if args.family != 'all':
             xpath = ("//ShowRouteTableSummary[contains(name, '%s.0')]/name" %
@@ -1263,6 +2505,80 @@ class CLI_ctr(CLI_basic):
 
         self.IST.printText(xpath)
 
+    def SnhRouteChurn(self, args):
+        """ poll the route table summaries and show the tables whose
+            prefix and path counts move fastest. Rates are net changes,
+            an add and a withdraw within one interval cancel out. """
+        params = OrderedDict([('search_string', args.search)])
+        if args.family != 'all':
+            push_search(args.family + '.0', params,
+                        [('search_string', lambda s: True)])
+        path = request_path('Snh_ShowRouteSummaryReq', params)
+        xpath = "//ShowRouteTableSummary"
+        if args.family != 'all':
+            xpath += "[contains(name, '%s.0')]" % args.family
+
+        fields = ['name', 'prefixes', 'prefixes/s', 'prefixes/s min/avg/max',
+                  'paths', 'paths/s', 'paths/s min/avg/max']
+        max_width = args.max_width or 50
+        # per table ring buffer of (prefixes/s, paths/s) of the last polls
+        history = {}
+        previous = None
+        reports = 0
+        try:
+            while True:
+                start = time.time()
+                self.IST.get(path, stream=True)
+                counts = {}
+                for tree in self.IST.output_etree:
+                    for table in compile_xpath(xpath)(tree):
+                        counts[table.find('name').text] = (
+                            int(table.find('prefixes').text),
+                            int(table.find('paths').text))
+
+                if previous is not None:
+                    elapsed = start - previous_time
+                    for name in list(history):
+                        if name not in counts:
+                            del history[name]
+                    for name, (prefixes, paths) in counts.items():
+                        if name not in previous:
+                            continue
+                        rates = history.setdefault(
+                            name, deque(maxlen=args.window))
+                        rates.append(
+                            ((prefixes - previous[name][0]) / elapsed,
+                             (paths - previous[name][1]) / elapsed))
+
+                    rows = []
+                    for name, rates in history.items():
+                        prefixes, paths = counts[name]
+                        row = [name]
+                        for count, i in [(prefixes, 0), (paths, 1)]:
+                            window = [r[i] for r in rates]
+                            row += [count, '%.1f' % rates[-1][i],
+                                    '%.1f/%.1f/%.1f' %
+                                    (min(window), sum(window) / len(window),
+                                     max(window))]
+                        rows.append((max(abs(rates[-1][0]),
+                                         abs(rates[-1][1])), row))
+                    rows.sort(key=lambda r: r[0], reverse=True)
+                    print("==== %s: %d tables, top %d by change rate" %
+                          (datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                           len(rows), min(args.top, len(rows))))
+                    self.IST.printRows(fields,
+                                       [r[1] for r in rows[:args.top]],
+                                       max_width)
+                    sys.stdout.flush()
+                    reports += 1
+                    if args.count and reports >= args.count:
+                        break
+
+                previous, previous_time = counts, start
+                time.sleep(max(0, args.interval - (time.time() - start)))
+        except KeyboardInterrupt:
+            pass
+
     def SnhShowRoute(self, args):
         shorter_match = ''
         longer_match = ''
@@ -1290,7 +2606,7 @@ class CLI_ctr(CLI_basic):
                  longer_match, shorter_match, args.source,
                  protocol, family ))
 
-        self.IST.get(path)
+        self.IST.get(path, stream=True)
 
         if args.detail:
             mode = 'detail'
@@ -1302,13 +2618,41 @@ class CLI_ctr(CLI_basic):
         # Family/source/protocl match is supported only from 3.2.
         # To handle the same in older releases, pass the prarmeters
         # to showrouter method
-        self.IST.showRoute_CTR(args.last, mode)
+        self.IST.showRoute_CTR(args.last, mode, args.format)
 
 class CLI_vr(CLI_basic):
     def __init__(self, parser, host, port, filename):
         CLI_basic.__init__(self, parser, host, port, filename)
+        # VRF name to index map, fetched on the first VRF given by name
+        self.vrf_indexes = None
         self.add_parse_args()
 
+    def refresh(self):
+        self.vrf_indexes = None
+
+    def vrf_index(self, vrf):
+        """ index of a VRF given by index, or by its full name or a part
+            of the name matching one VRF only """
+        if vrf.isdigit():
+            return vrf
+        if self.vrf_indexes is None:
+            self.IST.get('Snh_VrfListReq?name=', stream=True)
+            indexes = {}
+            for tree in self.IST.output_etree:
+                for data in compile_xpath('//VrfSandeshData')(tree):
+                    indexes[data.find('name').text] = \
+                        data.find('ucindex').text
+            self.vrf_indexes = indexes
+        if vrf in self.vrf_indexes:
+            return self.vrf_indexes[vrf]
+        matches = [name for name in self.vrf_indexes if vrf in name]
+        if len(matches) == 1:
+            return self.vrf_indexes[matches[0]]
+        if not matches:
+            raise IntrospectError("VRF %s not found" % vrf)
+        raise IntrospectError("VRF %s matches %s" %
+                              (vrf, ', '.join(sorted(matches))))
+
     def add_parse_args(self):
 
         ## show interfaces
@@ -1316,7 +2660,7 @@ class CLI_vr(CLI_basic):
                                          parents = [self.common_parser],
                                          help='Show vRouter interfaces')
         subp.add_argument('search', nargs='?', default='',
-                          help='Search string')
+                          help='Search string, or full IPv4 or MAC address')
         subp.add_argument('-u', '--uuid', default='', help='Interface uuid')
         subp.add_argument('-v', '--vn', default='', help='Virutal network')
         subp.add_argument('-n', '--name', default='', help='Interface name')
@@ -1355,8 +2699,8 @@ class CLI_vr(CLI_basic):
         subp = self.subparser.add_parser('route', help='Show routes')
         subp.add_argument('address', nargs='?', default='',
                           help='Address')
-        subp.add_argument('-v', '--vrf', type=int, default=0,
-                          help='VRF index, default: 0 (IP fabric)')
+        subp.add_argument('-v', '--vrf', default='0',
+                          help='VRF index or name, default: 0 (IP fabric)')
         subp.add_argument('-f', '--family',
                           choices=['inet', 'inet6','bridge','layer2', 'evpn'],
                           default='',
@@ -1367,6 +2711,14 @@ class CLI_vr(CLI_basic):
                           help='Display detailed output')
         subp.add_argument('-r', '--raw', action="store_true",
                           help='Display raw output in plain text')
+        subp.add_argument('--format', default='text',
+                          choices=['text', 'json', 'ndjson', 'csv'],
+                          help='Output format.')
+        subp.add_argument('--lookup-file',
+                          help='Resolve every IPv4/IPv6/MAC address listed '
+                               'in this file against the VRF tables')
+        subp.add_argument('--max_width', type=int,
+                          help="Max width per column of --lookup-file table")
         subp.set_defaults(func=self.SnhRoute)
 
         ## show security groups
@@ -1593,7 +2945,7 @@ class CLI_vr(CLI_basic):
         if (label):
           path += '&label=%s' % (label)
         xpath = '//MplsSandeshData'
-        self.IST.get(path)
+        self.IST.get(path, stream=True)
         self.output_formatters(args, xpath)
 
     def SnhVmList (self, args):
@@ -1618,7 +2970,7 @@ class CLI_vr(CLI_basic):
         default_columns = ['type', 'nh_index', 'policy', 'itf', 'mac', 'vrf',
                            'valid', 'ref_count', 'mc_list']
 
-        self.IST.get(path)
+        self.IST.get(path, stream=True)
         self.output_formatters(args, xpath, default_columns)
 
     def SnhServiceInstance(self, args):
@@ -1631,13 +2983,16 @@ class CLI_vr(CLI_basic):
         self.output_formatters(args, xpath, default_columns)
 
     def SnhItf(self, args):
-        path = 'Snh_ItfReq?name=' + args.name + '&type=&uuid=' \
-                + args.uuid + '&vn=' + args.vn + '&mac=' + args.mac \
-                + '&ipv4_address=' + args.ipv4
-        self.IST.get(path)
+        params = OrderedDict([('name', args.name), ('type', ''),
+                              ('uuid', args.uuid), ('vn', args.vn),
+                              ('mac', args.mac), ('ipv4_address', args.ipv4)])
+        pushed = push_search(args.search, params,
+                             [('ipv4_address', is_ipv4), ('mac', is_mac)])
+        self.IST.get(request_path('Snh_ItfReq', params), stream=True)
 
         xpath = "//ItfSandeshData"
-        if args.search: xpath += "[contains(., '%s')]" % args.search
+        if args.search and not pushed:
+            xpath += "[contains(., '%s')]" % args.search
 
         default_columns = ["index", "name", "active", "mac_addr", "ip_addr",
                            "mdata_ip_addr", "vm_name", "vn_name"]
@@ -1645,11 +3000,13 @@ class CLI_vr(CLI_basic):
         self.output_formatters(args, xpath, default_columns)
 
     def SnhKInterfaceReq(self, args):
-        path = 'Snh_KInterfaceReq'
-        self.IST.get(path)
+        # A digit search is not pushed down as if_id=: it matches every
+        # field containing it, e.g. interfaces 1, 10 and 11 for '1'.
+        self.IST.get('Snh_KInterfaceReq', stream=True)
 
         xpath = "//KInterfaceInfo"
-        if args.search: xpath += "[contains(., '%s')]" % args.search
+        if args.search:
+            xpath += "[contains(., '%s')]" % args.search
 
         default_columns = ["idx", "type", "flag", "vrf", "rid",
                            "os_idx", "mtu", "name"]
@@ -1658,7 +3015,7 @@ class CLI_vr(CLI_basic):
 
     def SnhVn(self, args):
         path = 'Snh_VnListReq?name=' + args.name + '&uuid=' + args.uuid
-        self.IST.get(path)
+        self.IST.get(path, stream=True)
 
         xpath = "//VnSandeshData"
         default_columns = ["name", "uuid", "layer2_forwarding",
@@ -1668,7 +3025,7 @@ class CLI_vr(CLI_basic):
 
     def SnhVrf(self, args):
         path = 'Snh_VrfListReq?name=' + args.name
-        self.IST.get(path)
+        self.IST.get(path, stream=True)
 
         xpath = "//VrfSandeshData"
         default_columns = ["name", "ucindex", "mcindex", "brindex",
@@ -1708,6 +3065,11 @@ class CLI_vr(CLI_basic):
 
     def SnhRoute(self, args):
 
+        args.vrf = self.vrf_index(args.vrf)
+        if args.lookup_file:
+            self.SnhRouteLookup(args)
+            return
+
         if args.family =='':
             if args.address == '' or is_ipv4(args.address):
                 args.family = 'inet'
@@ -1745,7 +3107,11 @@ class CLI_vr(CLI_basic):
             }
             path = mapping.get(args.family, '')[0] + str(args.vrf)
             xpath = mapping.get(args.family, '')[1]
-            if args.address: xpath += "[contains(mac, '%s')]" % args.address
+            params = OrderedDict()
+            if push_search(args.address, params, [('mac', is_mac)]):
+                path += '&mac=' + params['mac']
+            elif args.address:
+                xpath += "[contains(mac, '%s')]" % args.address
 
         if args.detail:
             mode = 'detail'
@@ -1754,8 +3120,68 @@ class CLI_vr(CLI_basic):
         else:
             mode ='brief'
 
-        self.IST.get(path)
-        self.IST.showRoute_VR(xpath, args.family, args.address, mode)
+        self.IST.get(path, stream=True)
+        self.IST.showRoute_VR(xpath, args.family, args.address, mode,
+                              args.format)
+
+    def SnhRouteLookup(self, args):
+        """ resolve all addresses of args.lookup_file, fetching each
+            family's table of the VRF only once """
+        try:
+            with open(args.lookup_file) as f:
+                addrs = [l.split('#')[0].strip() for l in f]
+        except IOError as e:
+            raise IntrospectError("ERROR: reading %s failed \n%s" %
+                                  (args.lookup_file, e))
+        addrs = [a for a in addrs if a]
+
+        tables = {
+            'inet': ('Snh_Inet4UcRouteReq?vrf_index=%s&src_ip=&prefix_len='
+                     '&stale=', '//RouteUcSandeshData', is_ipv4),
+            'inet6': ('Snh_Inet6UcRouteReq?vrf_index=%s&src_ip=&prefix_len='
+                      '&stale=', '//RouteUcSandeshData', is_ipv6),
+            'layer2': ('Snh_Layer2RouteReq?vrf_index=%s',
+                       '//RouteL2SandeshData', is_mac),
+        }
+        indexes = {}
+        # families whose table could not be fetched, and why
+        failed = {}
+        for family in ['inet', 'inet6', 'layer2']:
+            path, xpath, match = tables[family]
+            if any(match(a) for a in addrs):
+                try:
+                    self.IST.get(path % args.vrf, stream=True)
+                    indexes[match] = self.IST.routeIndex_VR(xpath, family)
+                except IntrospectError as e:
+                    # resolve the other families anyway
+                    sys.stderr.write("ERROR: %s table of vrf %s: %s\n" %
+                                     (family, args.vrf, e))
+                    failed[match] = family
+                    indexes[match] = None
+
+        rows = []
+        for addr in addrs:
+            route = None
+            for match, index in indexes.items():
+                if match(addr):
+                    if index is None:
+                        route = ('unresolved: %s table failed'
+                                 % failed[match], '-', '-', '-', '-')
+                    elif match is is_mac:
+                        route = index.get(normalize_mac(addr))
+                    else:
+                        routes = index.lookup(addr)
+                        route = routes[-1] if routes else None
+                    break
+            else:
+                rows.append([addr, 'invalid address', '-', '-', '-', '-'])
+                continue
+            rows.append([addr] + list(route or ('no route', '-', '-', '-',
+                                                '-')))
+
+        fields = ['address', 'prefix', 'nh_type', 'label', 'interface',
+                  'peer']
+        self.IST.printRows(fields, rows, args.max_width or Default_Max_Width)
 
     def SnhAgentStats(self, args):
         StatsMap = {
@@ -1904,6 +3330,42 @@ def valid_period(s):
         }
         return int(s[0:-1]) * mapping.get(s[-1], 0)
 
+def positive_int(s):
+    try:
+        value = int(s)
+    except ValueError:
+        value = 0
+    if value < 1:
+        raise argparse.ArgumentTypeError("%s is not an integer >= 1" % s)
+    return value
+
+Months = dict((m, i + 1) for i, m in enumerate(
+    ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+     'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']))
+
+# datetime of each 'YYYY-Mon-DD HH:MM:SS' prefix parsed so far. Routes
+# learnt together share the same second, and pathToStr parses the path
+# timestamps showRoute_CTR already parsed.
+Timestamp_Cache = {}
+Timestamp_Cache_Size = 4096
+
+def parse_timestamp(s):
+    """ same as datetime.strptime(s, '%Y-%b-%d %H:%M:%S.%f'), for the
+        sandesh last_modified timestamps """
+    t = Timestamp_Cache.get(s[:20])
+    if t is None:
+        if not (len(s) >= 20 and s[4] == '-' and s[8] == '-' and
+                s[11] == ' ' and s[5:8] in Months):
+            return datetime.strptime(s, '%Y-%b-%d %H:%M:%S.%f')
+        if len(Timestamp_Cache) >= Timestamp_Cache_Size:
+            Timestamp_Cache.clear()
+        t = Timestamp_Cache[s[:20]] = datetime(
+            int(s[0:4]), Months[s[5:8]], int(s[9:11]),
+            int(s[12:14]), int(s[15:17]), int(s[18:20]))
+    if len(s) > 21:
+        return t.replace(microsecond=int(s[21:27].ljust(6, '0')))
+    return t
+
 def is_ipv4(addr):
     try:
         socket.inet_pton(socket.AF_INET, addr)
@@ -1918,28 +3380,829 @@ def is_ipv6(addr):
         return False
     return True
 
-def addressInNetwork(addr, prefix):
-    ipaddr = struct.unpack('!L',socket.inet_aton(addr))[0]
-    pure_prefix = prefix.split(':')[-1]  # strip RD info if any
-    netaddr,bits = pure_prefix.split('/')
-    netaddr = struct.unpack('!L',socket.inet_aton(netaddr))[0]
-    netmask = ((1<<(32-int(bits))) - 1)^0xffffffff
-    return ipaddr & netmask == netaddr & netmask
-
-def addressInNetwork6(addr, prefix):
-    addr_upper,addr_lower = struct.unpack(
-                            '!QQ',socket.inet_pton(socket.AF_INET6, addr))
-    netaddr,bits = prefix.split('/')
-    net_upper,net_lower = struct.unpack(
-                          '!QQ',socket.inet_pton(socket.AF_INET6, netaddr))
-    if int(bits) < 65 :
-        netmask = ((1<<(64-int(bits))) - 1)^0xffffffffffffffff
-        return addr_upper & netmask == net_upper & netmask
-    elif addr_upper != net_upper:
+def is_mac(addr):
+    try:
+        return len([int(b, 16) for b in addr.split(':')]) == 6
+    except ValueError:
         return False
-    else:
-        netmask = ((1<<(128-int(bits))) - 1)^0xffffffffffffffff
-        return addr_lower & netmask == net_lower & netmask
+
+def normalize_mac(addr):
+    """ vrouter prints MACs without leading zeros, e.g. 2:84:4f:c3:40:2b """
+    return ':'.join('%x' % int(b, 16) for b in addr.split(':'))
+
+def push_search(search, params, candidates):
+    """ push search down into the first empty request parameter of
+        candidates, a list of (parameter, test), whose test accepts it.
+        returns False when search is left to the client-side predicate """
+    for param, test in candidates:
+        if search and not params.get(param) and test(search):
+            params[param] = search
+            if debug: print("DEBUG: search '%s' pushed down as %s=" %
+                            (search, param))
+            return True
+    if search and debug:
+        print("DEBUG: search '%s' filtered client side" % search)
+    return False
+
+def request_path(req, params):
+    """ introspect request path of req with params, an OrderedDict """
+    if not params:
+        return req
+    return req + '?' + '&'.join('%s=%s' % p for p in params.items())
+
+def decode_content(data, encoding, url=None):
+    """ body of a response sent with Content-Encoding 'encoding' """
+    encoding = (encoding or 'identity').lower()
+    if encoding not in ['gzip', 'deflate']:
+        return data
+    try:
+        # gzip, or deflate in its zlib wrapper
+        return zlib.decompress(data, 47)
+    except zlib.error as e:
+        if encoding == 'deflate':
+            # some servers send raw deflate
+            try:
+                return zlib.decompress(data, -15)
+            except zlib.error:
+                pass
+        raise IntrospectError('Failed to decode %s content\nURL: %s\n'
+                              'Reason: %s' % (encoding, url, e))
+
+def read_hosts(hosts):
+    """ --hosts value: comma separated addresses or a file listing them """
+    if os.path.isfile(hosts):
+        with open(hosts) as f:
+            hosts = ','.join(line.split('#')[0] for line in f)
+    return [h.strip() for h in hosts.replace('\n', ',').split(',')
+            if h.strip()]
+
+class ThreadOutput(object):
+    """ sys.stdout stand-in that collects the output of threads which
+        set a buffer, and passes everything else to the real stdout """
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.local = threading.local()
+
+    def capture(self, buf):
+        self.local.buf = buf
+
+    def write(self, data):
+        buf = getattr(self.local, 'buf', None)
+        if buf is not None:
+            buf.append(data)
+        else:
+            self.stdout.write(data)
+
+    def flush(self):
+        self.stdout.flush()
+
+def run_hosts(args, hosts):
+    """ run the selected CLI_* handler against all hosts concurrently.
+        Tables are merged into one table, and json, ndjson and csv records
+        into one document, with a leading host column. Text output is
+        printed per host and failures are reported on stderr at the end
+        instead of aborting the whole run. Returns the failed hosts. """
+    cli = args.func.__self__
+    handler = args.func.__name__
+    format = getattr(args, 'format', None)
+    results = dict((host, {'text': [], 'tables': [], 'records': [],
+                           'error': None})
+                   for host in hosts)
+    todo = queue.Queue()
+    for host in hosts:
+        todo.put(host)
+
+    def worker():
+        while True:
+            try:
+                host = todo.get_nowait()
+            except queue.Empty:
+                return
+            result = results[host]
+            sys.stdout.capture(result['text'])
+            host_cli = cli.for_host(host)
+            host_cli.IST.tables = result['tables']
+            host_cli.IST.records = result['records']
+            try:
+                getattr(host_cli, handler)(copy.copy(args))
+            except IntrospectError as e:
+                result['error'] = str(e).replace('\n', ' ')
+            except Exception as e:
+                result['error'] = '%s: %s' % (type(e).__name__, e)
+            finally:
+                host_cli.IST.close()
+                sys.stdout.capture(None)
+
+    stdout = sys.stdout
+    sys.stdout = ThreadOutput(stdout)
+    try:
+        threads = [threading.Thread(target=worker)
+                   for i in range(min(workers, len(hosts)))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        sys.stdout = stdout
+
+    for host in hosts:
+        text = ''.join(results[host]['text']).rstrip()
+        if text:
+            sys.stderr.write("==== %s ====\n" % host)
+            print(text)
+
+    max_width = getattr(args, 'max_width', None) or Default_Max_Width
+    ntables = max(len(results[host]['tables']) for host in hosts)
+    for i in range(ntables):
+        tables = [(host, results[host]['tables'][i]) for host in hosts
+                  if i < len(results[host]['tables'])]
+        # hosts running other versions may not have the same fields: use
+        # the union of them, in order of appearance, and leave the cells
+        # of fields a host does not have blank
+        merged_fields = []
+        for host, (fields, rows) in tables:
+            for f in fields:
+                if f not in merged_fields:
+                    merged_fields.append(f)
+        tbl = Introspect.newTbl(['host'] + merged_fields, max_width)
+        for host, (fields, rows) in tables:
+            for row in rows:
+                cells = dict(zip(fields, row))
+                tbl.add_row([host] + [cells.get(f, '')
+                                      for f in merged_fields])
+        print(tbl)
+
+    if format in ['json', 'ndjson', 'csv']:
+        writer = RecordWriter(format)
+        if format == 'csv':
+            merged_fields = []
+            for host in hosts:
+                for record, fields in results[host]['records']:
+                    for f in fields:
+                        if f not in merged_fields:
+                            merged_fields.append(f)
+        for host in hosts:
+            for record, fields in results[host]['records']:
+                if format == 'csv':
+                    cells = dict(zip(fields, record))
+                    writer.write([host] + [cells.get(f, '')
+                                           for f in merged_fields],
+                                 ['host'] + merged_fields)
+                else:
+                    writer.write(OrderedDict([('host', host)] +
+                                             list(record.items())))
+        writer.close()
+
+    failed = [host for host in hosts if results[host]['error']]
+    for host in failed:
+        sys.stderr.write("ERROR: %s: %s\n" % (host, results[host]['error']))
+    return failed
+
+# Fields identifying a table row across --watch polls, by preference.
+# Tables without any of them are keyed by their first column.
+Watch_Keys = ['peer', 'name', 'prefix', 'index', 'idx', 'controller_ip',
+              'uuid', 'nh_index', 'label']
+
+def keyed_rows(fields, rows):
+    """ rows of a table keyed by their natural key, with an occurrence
+        number to keep rows sharing a key apart """
+    key = next((fields.index(k) for k in Watch_Keys if k in fields), 0)
+    keyed = OrderedDict()
+    seen = {}
+    for row in rows:
+        n = seen.get(row[key], 0)
+        seen[row[key]] = n + 1
+        keyed[(row[key], n)] = row
+    return keyed
+
+def watch(args):
+    """ re-run the command every args.watch seconds. The first poll prints
+        the tables, later ones only the rows added, removed or changed,
+        with the changed fields highlighted. Returns on Ctrl-C, or at once
+        with 1 for commands printing text instead of tables. """
+    if args.format != 'table':
+        print("--watch needs table output")
+        return 1
+    cli = args.func.__self__
+    highlight = sys.stdout.isatty()
+    stdout = sys.stdout
+
+    def mark(new, old):
+        if new == old:
+            return new
+        if highlight:
+            return '\033[1;33m%s\033[0m' % new
+        return '%s *' % new
+
+    previous = None
+    try:
+        while True:
+            start = time.time()
+            tables = []
+            cli.IST.tables = tables
+            # text printed along the tables is not diffed
+            text = []
+            sys.stdout = ThreadOutput(stdout)
+            sys.stdout.capture(text)
+            poll_args = copy.copy(args)
+            try:
+                args.func(poll_args)
+            except IntrospectError as e:
+                tables = None
+                error = str(e).replace('\n', ' ')
+            finally:
+                sys.stdout = stdout
+                cli.IST.tables = None
+            now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            max_width = poll_args.max_width or Default_Max_Width
+
+            if tables is None:
+                print("==== %s ERROR: %s" % (now, error))
+            elif not tables and ''.join(text).strip():
+                # e.g. --detail output: nothing to diff
+                print("--watch needs a command printing tables")
+                return 1
+            elif previous is None:
+                previous = [(fields, keyed_rows(fields, rows))
+                            for fields, rows in tables]
+                for fields, rows in tables:
+                    cli.IST.printRows(fields, rows, max_width)
+            else:
+                current = [(fields, keyed_rows(fields, rows))
+                           for fields, rows in tables]
+                for i, (fields, rows) in enumerate(current):
+                    old = OrderedDict()
+                    if i < len(previous) and previous[i][0] == fields:
+                        old = previous[i][1]
+                    changes = []
+                    for key, row in rows.items():
+                        before = old.get(key)
+                        if before is None:
+                            changes.append(['+'] + row)
+                        elif before != row:
+                            changes.append(['~'] + [mark(new, prev) for
+                                                    new, prev in
+                                                    zip(row, before)])
+                    for key, row in old.items():
+                        if key not in rows:
+                            changes.append(['-'] + row)
+                    if len(changes):
+                        print("==== %s: %s" % (now, ' '.join(
+                            '%s%d' % (c, sum(1 for r in changes if r[0] == c))
+                            for c in '+-~')))
+                        tbl = Introspect.newTbl([''] + list(fields),
+                                                max_width)
+                        for row in changes:
+                            tbl.add_row(row)
+                        print(tbl)
+                previous = current
+            sys.stdout.flush()
+            time.sleep(max(0, args.watch - (time.time() - start)))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+class Shell(object):
+    """ ist shell: a prompt running ist commands in one process. The
+        introspect sessions, fetched pages, VRF maps and compiled xpaths
+        are kept across commands until 'refresh'. """
+    # commands polling for changes, which must not be served from cache
+    Polling = ['SnhRouteChurn']
+
+    def __init__(self, host, port, filename):
+        self.host = host
+        self.port = port
+        self.filename = filename
+        self.parser = argparse.ArgumentParser(prog='ist')
+        roleparsers = self.parser.add_subparsers(dest='role')
+        self.roles = {}
+        for svc in sorted(ServiceMap.keys()):
+            self.roles[svc] = roleparsers.add_parser(svc,
+                                                     help=ServiceMap[svc])
+        roleparsers.add_parser('refresh',
+                               help='Drop fetched pages and VRF maps')
+        roleparsers.add_parser('exit', help='Leave the shell')
+        self.clis = {}
+        self.cache = cache or MemoryCache()
+
+    def cli(self, role):
+        """ the CLI of role, built on first use """
+        if role not in self.clis and 'CLI_%s' % (role) in globals():
+            self.clis[role] = globals()['CLI_%s' % (role)](
+                self.roles[role], self.host, self.port, self.filename)
+        return self.clis.get(role)
+
+    def refresh(self):
+        # also drops on-disk pages of --cache-ttl
+        self.cache.clear()
+        for cli in self.clis.values():
+            cli.refresh()
+
+    def run(self, line):
+        """ run one command line """
+        global cache
+        tokens = shlex.split(line)
+        if not tokens:
+            return
+        if tokens[0] in ['exit', 'quit']:
+            raise EOFError
+        if tokens[0] == 'refresh':
+            self.refresh()
+            return
+        if tokens[0] in ServiceMap:
+            self.cli(tokens[0])
+        try:
+            args, unknown = self.parser.parse_known_args(tokens)
+        except SystemExit:
+            return
+        if "func" not in args:
+            if args.role in self.roles:
+                self.roles[args.role].print_usage()
+            return
+
+        polling = (getattr(args, 'watch', None) or
+                   args.func.__name__ in self.Polling)
+        cache = None if polling else self.cache
+        try:
+            if getattr(args, 'watch', None):
+                watch(args)
+            else:
+                args.func(args)
+        except IntrospectError as e:
+            print(e)
+        finally:
+            cache = self.cache
+
+    def loop(self):
+        """ read and run commands until exit or end of input """
+        global cache
+        try:
+            import readline
+        except ImportError:
+            pass
+        cache = self.cache
+        prompt = 'ist> ' if sys.stdin.isatty() else ''
+        try:
+            while True:
+                try:
+                    line = input(prompt)
+                except EOFError:
+                    break
+                try:
+                    self.run(line)
+                except EOFError:
+                    break
+                except KeyboardInterrupt:
+                    print('')
+                except ValueError as e:
+                    # unbalanced quotes
+                    print(e)
+                sys.stdout.flush()
+        finally:
+            for cli in self.clis.values():
+                cli.IST.close()
+        return 0
+
+class SingleFlight(object):
+    """ results of calls by key, kept for ttl seconds. Concurrent calls
+        for a key being computed wait for that computation instead of
+        starting their own. """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.results = {}
+        self.flights = {}
+
+    def do(self, key, func, keep=lambda result: True):
+        """ func() for key, or its kept or in-flight result. Returns the
+            result and 'hit', 'coalesced' or 'miss'. Only results passing
+            keep are kept. An exception of func() is raised in every
+            caller waiting for it. """
+        with self.lock:
+            now = time.time()
+            if key in self.results:
+                stamp, result = self.results[key]
+                if now - stamp < self.ttl:
+                    return result, 'hit'
+                del self.results[key]
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = {'done': threading.Event(),
+                                              'result': None, 'error': None}
+        if not leader:
+            flight['done'].wait()
+            if flight['error'] is not None:
+                raise flight['error']
+            return flight['result'], 'coalesced'
+        try:
+            flight['result'] = func()
+        except BaseException as e:
+            flight['error'] = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+                if flight['error'] is None and keep(flight['result']):
+                    if len(self.results) >= 1024:
+                        # drop the expired results
+                        for k, (stamp, r) in list(self.results.items()):
+                            if now - stamp >= self.ttl:
+                                del self.results[k]
+                    self.results[key] = (time.time(), flight['result'])
+            flight['done'].set()
+        return flight['result'], 'miss'
+
+def serve(host, hosts, port, filename, listen, ttl):
+    """ ist serve: answer GET /<role>/<command>[/<argument>...][?option=value]
+        with the output of that ist command as json, e.g.
+        /ctr/nei?type=BGP or /vr/route/10.1.1.1?vrf=2. A host= parameter
+        picks one of --hosts. Identical requests share one run of the
+        command per ttl seconds, and fetched pages are cached for ttl. """
+    global cache
+    try:
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+        from socketserver import ThreadingMixIn
+        from urllib.parse import urlparse, parse_qs, unquote
+    except ImportError:
+        from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+        from SocketServer import ThreadingMixIn
+        from urlparse import urlparse, parse_qs
+        from urllib import unquote
+
+    host = host or '127.0.0.1'
+    allowed = hosts or [host]
+    if not cache:
+        cache = MemoryCache(ttl)
+    flight = SingleFlight(ttl)
+
+    parser = argparse.ArgumentParser(prog='ist')
+    roleparsers = parser.add_subparsers(dest='role')
+    clis = {}
+    for svc in sorted(ServiceMap.keys()):
+        p = roleparsers.add_parser(svc, help=ServiceMap[svc])
+        if 'CLI_%s' % (svc) in globals():
+            clis[svc] = globals()['CLI_%s' % (svc)](p, host, port, filename)
+    # idle CLI copies by (role, host), each keeping its keep-alive session
+    idle = {}
+    idle_lock = threading.Lock()
+
+    def run(role, target, tokens):
+        """ run tokens as an ist command, returns (status, json data) """
+        try:
+            args, unknown = parser.parse_known_args(tokens)
+        except SystemExit:
+            return 400, {'error': 'invalid command: %s' % ' '.join(tokens)}
+        if "func" not in args:
+            return 400, {'error': 'incomplete command: %s' %
+                                  ' '.join(tokens)}
+        if (getattr(args, 'watch', None) or
+                args.func.__name__ in Shell.Polling):
+            return 400, {'error': 'polling commands are not served'}
+        if getattr(args, 'format', None) in ['table', 'text']:
+            args.format = 'json'
+
+        with idle_lock:
+            free = idle.setdefault((role, target), [])
+            cli = free.pop() if free else None
+        if cli is None:
+            cli = clis[role].for_host(target)
+        out = []
+        sys.stdout.capture(out)
+        try:
+            getattr(cli, args.func.__name__)(args)
+        except IntrospectError as e:
+            return 502, {'error': str(e)}
+        finally:
+            sys.stdout.capture(None)
+            with idle_lock:
+                idle[(role, target)].append(cli)
+        text = ''.join(out)
+        try:
+            return 200, json.loads(text)
+        except ValueError:
+            return 200, {'output': text}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            if debug:
+                BaseHTTPRequestHandler.log_message(self, format, *args)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            tokens = [unquote(t) for t in url.path.split('/') if t]
+            query = parse_qs(url.query, keep_blank_values=True)
+            target = query.pop('host', [host])[0]
+            if not tokens:
+                status, data, how = 200, {'roles': sorted(clis)}, 'miss'
+            elif target not in allowed:
+                status, data, how = 403, {'error': 'host %s is not served'
+                                                   % target}, 'miss'
+            elif tokens[0] not in clis:
+                status, data, how = 404, {'error': 'unknown role %s'
+                                                   % tokens[0]}, 'miss'
+            else:
+                for option in sorted(query):
+                    tokens.append('--' + option)
+                    tokens += [v for v in query[option] if v]
+                try:
+                    (status, data), how = flight.do(
+                        (target, tuple(tokens)),
+                        lambda: run(tokens[0], target, tokens),
+                        lambda result: result[0] == 200)
+                except Exception as e:
+                    status, data, how = 500, {'error': '%s: %s' %
+                                              (type(e).__name__, e)}, 'miss'
+            body = json.dumps(data).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('X-Cache', how)
+            self.end_headers()
+            self.wfile.write(body)
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+        allow_reuse_address = True
+
+    address, _, listen_port = listen.rpartition(':')
+    server = Server((address or '127.0.0.1', int(listen_port)), Handler)
+    stdout = sys.stdout
+    sys.stdout = ThreadOutput(stdout)
+    stdout.write("Serving %s on http://%s:%d/\n" %
+                 (', '.join(allowed), server.server_address[0],
+                  server.server_address[1]))
+    stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sys.stdout = stdout
+        server.server_close()
+        for free in idle.values():
+            for cli in free:
+                cli.IST.close()
+    return 0
+
+# introspect documents read by ist export, by role: the request, then the
+# metric families read from its document as (xpath, metric name, label
+# fields, fields). The numeric leaves of the matching elements are exported,
+# all of them when fields is None. Listed non numeric fields are exported
+# as 1 with their text in a label, e.g. state="Established".
+Export_Map = OrderedDict([
+    ('vr', [
+        ('Snh_AgentStatsReq', [
+            ('//IpcStatsResp', 'vrouter', [], None),
+            ('//PktTrapStatsResp', 'vrouter_pkt_trap', [], None),
+            ('//FlowStatsResp', 'vrouter', [], None),
+        ]),
+        ('Snh_CpuLoadInfoReq', [('//CpuLoadInfo', 'cpu', [], None)]),
+    ]),
+    ('ctr', [
+        ('Snh_ShowXmppServerReq', [
+            ('//ShowXmppServerResp', 'control_xmpp_server', [], None),
+        ]),
+        ('Snh_BgpNeighborReq', [
+            ('//BgpNeighborResp', 'control_bgp_neighbor',
+             ['peer', 'peer_address', 'encoding'], ['flap_count', 'state']),
+        ]),
+        ('Snh_CpuLoadInfoReq', [('//CpuLoadInfo', 'cpu', [], None)]),
+    ]),
+    ('collector', [
+        ('Snh_ShowCollectorServerReq', [
+            ('/ShowCollectorServerResp/errors/DbErrors',
+             'collector_db_errors', [], None),
+        ]),
+        ('Snh_CpuLoadInfoReq', [('//CpuLoadInfo', 'cpu', [], None)]),
+    ]),
+])
+
+def metric_value(text):
+    """ float value of a numeric or boolean leaf, None for other text """
+    if text in ('true', 'false'):
+        return float(text == 'true')
+    try:
+        value = float(text)
+    except ValueError:
+        return None
+    if value != value or value in (float('inf'), float('-inf')):
+        return None
+    return value
+
+def metric_samples(node, name, fields=None):
+    """ yield (name, value, text) for the leaves of node, structs being
+        flattened into name_struct_field. text is set for non numeric
+        fields listed in fields, others are skipped. """
+    for child in node:
+        if child.tag == 'more' or child.get('type') == 'list':
+            continue
+        if fields is not None and child.tag not in fields:
+            continue
+        child_name = name + '_' + child.tag
+        if child.get('type') == 'struct':
+            for member in child:
+                for sample in metric_samples(member, child_name):
+                    yield sample
+            continue
+        if len(child):
+            continue
+        text = (child.text or '').strip()
+        value = metric_value(text)
+        if value is not None:
+            yield child_name, value, None
+        elif fields is not None:
+            yield child_name, 1.0, text
+
+class Exporter(object):
+    """ metrics of the introspect counters of Export_Map, in the
+        Prometheus text format. Each document is fetched once per scrape
+        and the targets are scraped concurrently. Scrapes closer than
+        'interval' seconds share the same result. """
+    def __init__(self, targets, roles, port, interval):
+        self.targets = targets
+        self.roles = roles
+        self.port = port
+        self.flight = SingleFlight(interval)
+        # Introspect by (host, role), kept across scrapes for keep-alive
+        self.ists = {}
+
+    def introspect(self, host, role):
+        if (host, role) not in self.ists:
+            port = self.port
+            if port is None:
+                port = CLI_basic.IntrospectPortMap[ServiceMap[role]]
+            self.ists[(host, role)] = Introspect(host, port, None)
+        return self.ists[(host, role)]
+
+    def scrape_target(self, host, role):
+        """ samples of one role on host, as (name, labels, value, help) """
+        ist = self.introspect(host, role)
+        labels = [('host', host), ('role', role)]
+        samples = []
+        start = time.time()
+        try:
+            for request, families in Export_Map[role]:
+                ist.get(request)
+                for xpath, name, label_fields, fields in families:
+                    help = '%s %s' % (request, xpath)
+                    prefix = 'contrail_' + name
+                    for tree in ist.output_etree:
+                        for node in compile_xpath(xpath)(tree):
+                            node_labels = labels + [
+                                (f, Introspect.fieldStr(node, f))
+                                for f in label_fields]
+                            for metric, value, text in metric_samples(
+                                    node, prefix, fields):
+                                sample_labels = node_labels
+                                if text is not None:
+                                    # e.g. ..._state{state="Established"} 1
+                                    sample_labels = node_labels + [
+                                        (metric[len(prefix) + 1:], text)]
+                                samples.append((metric, sample_labels, value,
+                                                help))
+                ist.output_etree = None
+            up = 1.0
+        except IntrospectError as e:
+            if debug: print("DEBUG: export %s %s: %s" % (host, role, e))
+            up = 0.0
+        samples.append(('contrail_up', labels, up,
+                        'Whether the last scrape of the introspect port '
+                        'succeeded'))
+        samples.append(('contrail_scrape_duration_seconds', labels,
+                        time.time() - start,
+                        'Seconds taken by the last scrape of the introspect '
+                        'port'))
+        return samples
+
+    def scrape(self):
+        """ scrape all targets, returns the metrics text """
+        jobs = [(host, role) for host in self.targets for role in self.roles]
+        results = {}
+        todo = queue.Queue()
+        for job in jobs:
+            todo.put(job)
+
+        def worker():
+            while True:
+                try:
+                    job = todo.get_nowait()
+                except queue.Empty:
+                    return
+                results[job] = self.scrape_target(*job)
+
+        threads = [threading.Thread(target=worker)
+                   for i in range(min(workers, len(jobs)))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+
+        families = OrderedDict()
+        for job in jobs:
+            for name, labels, value, help in results.get(job, []):
+                families.setdefault(name, (help, []))[1].append(
+                    (labels, value))
+        lines = []
+        for name, (help, samples) in families.items():
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s gauge' % (name))
+            for labels, value in samples:
+                lines.append('%s{%s} %s' % (
+                    name, ','.join('%s="%s"' % (k, metric_label(v))
+                                   for k, v in labels),
+                    metric_number(value)))
+        return '\n'.join(lines) + '\n'
+
+    def metrics(self):
+        """ metrics text, scraped at most once per interval """
+        return self.flight.do('metrics', self.scrape)[0]
+
+    def close(self):
+        for ist in self.ists.values():
+            ist.close()
+
+def metric_label(text):
+    """ text escaped as a Prometheus label value """
+    return text.replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+def metric_number(value):
+    """ value formatted as a Prometheus sample value """
+    if value.is_integer() and abs(value) < 2 ** 53:
+        return str(int(value))
+    return repr(value)
+
+def export(host, hosts, port, roles, listen, interval):
+    """ ist export: print the metrics of Export_Map once, or serve them
+        on http://listen/metrics for Prometheus to scrape """
+    exporter = Exporter(hosts or [host or '127.0.0.1'], roles, port,
+                        interval)
+    if not listen:
+        try:
+            sys.stdout.write(exporter.scrape())
+        finally:
+            exporter.close()
+        return 0
+    try:
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+        from socketserver import ThreadingMixIn
+    except ImportError:
+        from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+        from SocketServer import ThreadingMixIn
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            if debug:
+                BaseHTTPRequestHandler.log_message(self, format, *args)
+
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                status, body = 404, 'see /metrics\n'
+            else:
+                status, body = 200, exporter.metrics()
+            body = body.encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type',
+                             'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+        allow_reuse_address = True
+
+    address, _, listen_port = listen.rpartition(':')
+    server = Server((address or '127.0.0.1', int(listen_port)), Handler)
+    print("Exporting metrics on http://%s:%d/metrics" %
+          server.server_address[:2])
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        exporter.close()
+    return 0
+
+def async_engine():
+    """ Engine of ist_async.py, run by a background event loop """
+    # ist_async imports this module as ist
+    sys.modules.setdefault('ist', sys.modules[__name__])
+    try:
+        import ist_async
+    except (ImportError, SyntaxError) as e:
+        raise IntrospectError("--engine async needs Python 3.6+ and "
+                              "ist_async.py next to ist.py: %s" % e)
+    return ist_async.Engine(pool_size)
 
 def validate_uuid(id):
     try:
@@ -1969,6 +4232,18 @@ def main():
     except ValueError:
         pass
 
+    hosts = None
+    try:
+        hosts = read_hosts(argv[argv.index('--hosts') + 1])
+    except ValueError:
+        pass
+
+    global workers
+    try:
+        workers = int(argv[argv.index('--workers') + 1])
+    except ValueError:
+        pass
+
     try:
         port = argv[argv.index('--port') + 1]
     except ValueError:
@@ -1989,39 +4264,199 @@ def main():
     except ValueError:
         pass
 
+    global prefetch
+    try:
+        prefetch = int(argv[argv.index('--prefetch') + 1])
+    except ValueError:
+        pass
+
+    global pool_size
+    try:
+        pool_size = int(argv[argv.index('--pool-size') + 1])
+    except ValueError:
+        pass
+
     if filename and not os.path.isfile(filename):
         print("Failed to find " + filename)
         sys.exit(1)
 
+    global capture
+    try:
+        capture = PageArchive(argv[argv.index('--capture') + 1], 'w')
+    except ValueError:
+        pass
+
     if host:
-        print("Introspect Host: " + host)
+        # on stderr, to keep json, csv and metrics output parseable
+        sys.stderr.write("Introspect Host: %s\n" % host)
 
     global debug
     if '--debug' in argv:
         debug = True
 
+    global engine
+    try:
+        if argv[argv.index('--engine') + 1] == 'async':
+            engine = async_engine()
+    except ValueError:
+        pass
+    except IntrospectError as e:
+        print(e)
+        sys.exit(1)
+
+    global profile
+    profile_json = None
+    try:
+        profile_json = argv[argv.index('--profile-json') + 1]
+    except ValueError:
+        pass
+    if ('--profile' in argv or '--profile-memory' in argv or
+            profile_json):
+        profile = Profile()
+        profile.instrument('--profile-memory' in argv)
+
     parser = argparse.ArgumentParser(prog='ist',
         description='A script to make Contrail Introspect output CLI friendly.')
     parser.add_argument('--version',  action="store_true",  help="Script version")
     parser.add_argument('--debug',    action="store_true",  help="Verbose mode")
     parser.add_argument('--host',     type=str,             help="Introspect host address. Default: localhost")
+    parser.add_argument('--hosts',    type=str,             help="Comma separated host addresses, or a file listing them, to query concurrently")
+    parser.add_argument('--workers',  type=int,             help="Max hosts queried at the same time with --hosts. Default: %d" % workers)
     parser.add_argument('--port',     type=int,             help="Introspect port number")
     parser.add_argument('--proxy',    type=str,             help="Introspect proxy URL")
     parser.add_argument('--token',    type=str,             help="Token for introspect proxy requests")
-    parser.add_argument('--file',     type=str,             help="Introspect file")
-
-    roleparsers = parser.add_subparsers()
-
+    parser.add_argument('--file',     type=str,             help="Introspect file, or archive saved with --capture")
+    parser.add_argument('--capture',  type=str,             help="Save every fetched page into this archive for replay with --file")
+    parser.add_argument('--prefetch', type=int,             help="Number of pages to fetch ahead while rendering. Default: 0 (serial)")
+    parser.add_argument('--pool-size', type=int,            help="Max keep-alive connections per host. Default: %d" % pool_size)
+    parser.add_argument('--engine',   choices=['sync', 'async'], help="Fetch pages with requests (sync) or with the asyncio client of ist_async.py (async, Python 3.6+). Default: sync")
+    parser.add_argument('--max-per-host', type=int,         help="Max requests in flight per introspect server, lowered automatically while it answers slowly. Default: 4")
+    parser.add_argument('--rate',     type=float,           help="Max requests per second over all introspect servers. Default: unlimited")
+    parser.add_argument('--load-aware', action="store_true", help="Send one request at a time to servers whose cpu load is above 0.8 per cpu")
+    parser.add_argument('--cache-ttl', type=valid_period,   help="Serve pages fetched during this period (e.g. 30s, 5m) from the on-disk cache")
+    parser.add_argument('--cache-dir', type=str,            help="On-disk cache directory. Default: <tmpdir>/ist-cache-<uid>")
+    parser.add_argument('--profile',  action="store_true",  help="Report time per phase (network, parse, xpath, render), pages, bytes, records and peak memory on stderr")
+    parser.add_argument('--profile-memory', action="store_true", help="--profile, plus the peak of traced python memory. Slows the run down several times")
+    parser.add_argument('--profile-json', type=str,         help="Write the --profile report as json to this file")
+
+    roleparsers = parser.add_subparsers(dest='role')
+
+    roles = {}
     for svc in sorted(ServiceMap.keys()):
-        p = roleparsers.add_parser(svc, help=ServiceMap[svc])
-        if 'CLI_%s' % (svc) in globals():
-            globals()['CLI_%s' % (svc)](p, host, port, filename)
+        roles[svc] = roleparsers.add_parser(svc, help=ServiceMap[svc])
+    roleparsers.add_parser('shell', help='Interactive shell keeping '
+                           'connections and fetched pages across commands')
+    p = roleparsers.add_parser('serve', help='Serve the commands as an '
+                               'HTTP/JSON API, coalescing identical requests')
+    p.add_argument('--listen', default='127.0.0.1:8180',
+                   help="Address and port to listen on "
+                        "(default=%(default)s)")
+    p.add_argument('--ttl', type=valid_period, default=5,
+                   help='Seconds a result and its pages are reused, e.g. '
+                        '5s, 1m. 5s by default')
+    p = roleparsers.add_parser('export', help='Print the introspect '
+                               'counters as Prometheus metrics, or serve '
+                               'them with --listen')
+    p.add_argument('--roles', nargs='+', choices=list(Export_Map.keys()),
+                   default=list(Export_Map.keys()),
+                   help='Roles to scrape on each host (default=%(default)s)')
+    p.add_argument('--listen', help="Address:port to serve /metrics on, "
+                                    "e.g. 0.0.0.0:9185")
+    p.add_argument('--interval', type=valid_period, default=10,
+                   help='Seconds the metrics are reused across scrapes, e.g. '
+                        '10s, 1m. 10s by default')
+
+    # Building the commands of every role is most of the startup time,
+    # so only build those of the role given on the command line.
+    role = parser.parse_known_args([a for a in argv
+                                    if a not in ['-h', '--help']])[0].role
+    if role and 'CLI_%s' % (role) in globals():
+        globals()['CLI_%s' % (role)](roles[role], host, port, filename)
+
+    # Requests are only scheduled when asked to, or when they can run in
+    # parallel; a serial run sends them directly.
+    global scheduler
+    per_host, rate = 4, None
+    try:
+        per_host = int(argv[argv.index('--max-per-host') + 1])
+    except ValueError:
+        pass
+    try:
+        rate = float(argv[argv.index('--rate') + 1])
+    except ValueError:
+        pass
+    if ('--max-per-host' in argv or rate or '--load-aware' in argv or
+            (hosts and len(hosts) > 1) or prefetch or
+            role in ['serve', 'export']):
+        scheduler = Scheduler(per_host, rate,
+                              load_aware='--load-aware' in argv)
 
     args, unknown = parser.parse_known_args()
-    if ("func" in args):
-      args.func(args)
-    else:
-      parser.print_usage()
+
+    # Like the other global options, the cache options may follow the
+    # command, where the parser above leaves them unparsed: parse them
+    # on their own, so that argparse reports their errors.
+    cache_parser = argparse.ArgumentParser(prog='ist', add_help=False)
+    cache_parser.add_argument('--cache-ttl', type=valid_period)
+    cache_parser.add_argument('--cache-dir', type=str)
+    cache_argv = []
+    for i, a in enumerate(argv):
+        if a.split('=')[0] in ['--cache-ttl', '--cache-dir']:
+            cache_argv += argv[i:i + (1 if '=' in a else 2)]
+    cache_args = cache_parser.parse_args(cache_argv)
+    global cache
+    if cache_args.cache_ttl is not None:
+        cache = PageCache(cache_args.cache_ttl, cache_args.cache_dir or
+                          os.environ.get('INTROSPECT_CACHE_DIR', None))
+
+    rc = 0
+    try:
+        if args.role == 'shell':
+            rc = Shell(host, port, filename).loop()
+        elif args.role == 'serve':
+            rc = serve(host, hosts, port, filename, args.listen, args.ttl)
+        elif args.role == 'export':
+            rc = export(host, hosts, port, args.roles, args.listen,
+                        args.interval)
+        elif ("func" in args) and hosts and getattr(args, 'watch', None):
+            print("--watch polls a single --host")
+            rc = 1
+        elif ("func" in args) and hosts:
+            if run_hosts(args, hosts):
+                rc = 1
+        elif ("func" in args) and getattr(args, 'watch', None):
+            try:
+                rc = watch(args)
+            finally:
+                args.func.__self__.IST.close()
+        elif ("func" in args):
+            try:
+                if profile:
+                    profile.timed('render', args.func)(args)
+                else:
+                    args.func(args)
+            except IntrospectError as e:
+                print(e)
+                rc = 1
+            finally:
+                args.func.__self__.IST.close()
+        else:
+            parser.print_usage()
+    finally:
+        if capture:
+            capture.close()
+
+    if debug and cache:
+        print("DEBUG: cache %d hits, %d misses" % (cache.hits, cache.misses))
+
+    if profile and "func" in args:
+        profile.printReport(profile_json)
+
+    if engine:
+        engine.close()
+
+    if rc:
+        sys.exit(rc)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,293 @@
+"""
+asyncio introspect client for ist.py, Python 3.6+.
+
+    client = AsyncIntrospect('10.0.0.1', 8085)
+    async for tree in client.pages('Snh_ItfReq'):
+        ...
+    await client.close()
+
+One event loop holds any number of requests in flight, each on a pooled
+keep-alive HTTP/1.1 connection, instead of a thread per request. Pages
+follow the next_batch and Snh_PageReq pagination of Introspect.get, URLs
+the --proxy forward-proxy rewriting and requests carry the X-Auth-Token.
+
+ist.py --engine async runs the synchronous CLI on top of it: Engine runs
+the event loop in a background thread and Introspect.download waits for
+each page there.
+"""
+
+import asyncio
+import ssl
+import threading
+from collections import deque
+from urllib.parse import urlencode, urlsplit
+
+# with ist.py run as a script, import ist gets the running __main__ module
+import ist
+from ist import Introspect, IntrospectError, decode_content
+
+Default_Timeout = 60
+Default_Ports = {'http': 80, 'https': 443}
+
+
+class Headers(dict):
+    """ response headers, looked up by case insensitive name """
+    def __getitem__(self, name):
+        return dict.__getitem__(self, name.lower())
+
+    def get(self, name, default=None):
+        return dict.get(self, name.lower(), default)
+
+
+class Response(object):
+    """ the parts of a requests response used by ist.py. content is the
+        body as received, still compressed with Content-Encoding """
+    def __init__(self, url, status_code, headers, content):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return decode_content(self.content,
+                              self.headers.get('content-encoding'),
+                              self.url).decode('utf-8', 'replace')
+
+    def close(self):
+        pass
+
+
+class Client(object):
+    """ HTTP/1.1 GET client keeping at most pool_size connections per
+        server, idle ones being reused for the next requests. It accepts
+        gzip and deflate content, left to the caller to decode. """
+    def __init__(self, pool_size=10, timeout=Default_Timeout):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.idle = {}
+        self.slots = {}
+        # requests and connections by server, for --debug
+        self.stats = {}
+
+    async def get(self, url, headers=None, timeout=None):
+        """ GET url, retried once on a new connection when a reused one
+            was closed by the server. Raises IntrospectError when the
+            server cannot be reached or does not answer within timeout
+            seconds. """
+        parts = urlsplit(url)
+        server = (parts.scheme, parts.hostname,
+                  parts.port or Default_Ports[parts.scheme])
+        target = parts.path or '/'
+        if parts.query:
+            target += '?' + parts.query
+        request = ['GET %s HTTP/1.1' % target,
+                   'Host: %s' % parts.netloc,
+                   'Accept-Encoding: gzip, deflate']
+        for name, value in (headers or {}).items():
+            request.append('%s: %s' % (name, value))
+        request = ('\r\n'.join(request) + '\r\n\r\n').encode('latin-1')
+
+        if server not in self.slots:
+            self.slots[server] = asyncio.Semaphore(self.pool_size)
+            self.idle[server] = deque()
+            self.stats[server] = [0, 0]
+        try:
+            async with self.slots[server]:
+                return await asyncio.wait_for(
+                    self.send(server, url, request),
+                    timeout or self.timeout)
+        except asyncio.TimeoutError:
+            raise IntrospectError('Failed to reach destination\nURL: %s\n'
+                                  'Reason: no answer in %ss' %
+                                  (url, timeout or self.timeout))
+        except (OSError, EOFError, ValueError,
+                asyncio.IncompleteReadError) as e:
+            raise IntrospectError('Failed to reach destination\nURL: %s\n'
+                                  'Reason: %s' % (url, e))
+
+    async def send(self, server, url, request):
+        while True:
+            reused = bool(self.idle[server])
+            if reused:
+                reader, writer = self.idle[server].popleft()
+            else:
+                scheme, host, port = server
+                reader, writer = await asyncio.open_connection(
+                    host, port,
+                    ssl=ssl.create_default_context()
+                        if scheme == 'https' else None)
+                self.stats[server][1] += 1
+            try:
+                writer.write(request)
+                await writer.drain()
+                status_line = await reader.readline()
+                if not status_line and reused:
+                    # the server closed the idle connection
+                    writer.close()
+                    continue
+                response, keep = await self.read(reader, url, status_line)
+            except BaseException:
+                # also on cancellation: the connection is mid-response
+                writer.close()
+                raise
+            self.stats[server][0] += 1
+            if keep:
+                self.idle[server].append((reader, writer))
+            else:
+                writer.close()
+            return response
+
+    async def read(self, reader, url, status_line):
+        """ read the response after status_line. Returns it and whether
+            the connection can be reused. """
+        version, status = status_line.decode('latin-1').split(None, 2)[:2]
+        headers = Headers()
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n'):
+                break
+            if not line:
+                raise EOFError('connection closed in headers')
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        keep = (version == 'HTTP/1.1' and
+                headers.get('connection', '').lower() != 'close')
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if not size:
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            # trailers
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            content = b''.join(chunks)
+        elif 'content-length' in headers:
+            content = await reader.readexactly(
+                int(headers['content-length']))
+        else:
+            content = await reader.read()
+            keep = False
+        return Response(url, int(status), headers, content), keep
+
+    def close(self):
+        for connections in self.idle.values():
+            for reader, writer in connections:
+                writer.close()
+            connections.clear()
+
+
+class AsyncIntrospect(object):
+    """ asyncio counterpart of Introspect.get for one introspect server """
+    def __init__(self, host, port, proxy=None, token=None,
+                 timeout=Default_Timeout, client=None, pool_size=10):
+        self.host_url = 'http://%s:%s/' % (host, port)
+        self.proxy = proxy
+        self.token = token
+        self.timeout = timeout
+        self.client = client or Client(pool_size, timeout)
+
+    def url(self, path):
+        url = self.host_url + path.replace(' ', '%20')
+        if self.proxy and self.token:
+            url = self.proxy + "/forward-proxy?" + \
+                  urlencode({'proxyURL': url})
+        return url
+
+    def headers(self):
+        if self.proxy and self.token:
+            return {'X-Auth-Token': self.token}
+        return {}
+
+    async def fetch(self, path, timeout=None):
+        """ decoded bytes of one introspect page """
+        url = self.url(path)
+        response = await self.client.get(url, self.headers(), timeout)
+        if response.status_code >= 400:
+            raise IntrospectError('The server couldn\'t fulfill the '
+                                  'request.\nURL: %s\nError code: %s\n'
+                                  'Error text: %s' %
+                                  (url, response.status_code,
+                                   response.text))
+        return decode_content(response.content,
+                              response.headers.get('content-encoding'), url)
+
+    async def pages(self, path, timeout=None):
+        """ async iterator over the parsed pages of the output of path """
+        while path:
+            tree = ist.etree.fromstring(await self.fetch(path, timeout))
+            keep, path = Introspect.nextPage(path, tree)
+            if keep:
+                yield tree
+
+    async def get(self, path, timeout=None):
+        """ all parsed pages of the output of path """
+        return [tree async for tree in self.pages(path, timeout)]
+
+    async def close(self):
+        self.client.close()
+
+
+class Engine(object):
+    """ event loop run in a background thread, for synchronous callers """
+    def __init__(self, pool_size=10, timeout=Default_Timeout):
+        self.loop = asyncio.new_event_loop()
+        self.client = Client(pool_size, timeout)
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, coroutine):
+        """ result of coroutine run in the event loop. It is cancelled
+            when the caller is interrupted. """
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        try:
+            return future.result()
+        except BaseException:
+            future.cancel()
+            raise
+
+    def get(self, url, headers=None):
+        return self.run(self.client.get(url, headers))
+
+    def close(self):
+        if ist.debug:
+            for (scheme, host, port), (count, connections) in \
+                    self.client.stats.items():
+                print("DEBUG: %s:%s %d requests over %d connections "
+                      "(%d reused)" % (host, port, count, connections,
+                                       count - connections))
+        self.loop.call_soon_threadsafe(self.client.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+def fanout(host, port, path, count):
+    """ walk the pages of path count times at once, on one client with a
+        connection per walk. Returns the pages walked. Used by the
+        fanout benchmark of ist_bench.py. """
+    async def walk(introspect):
+        pages = 0
+        async for tree in introspect.pages(path):
+            pages += 1
+        return pages
+
+    async def run():
+        client = Client(pool_size=count)
+        try:
+            walks = [walk(AsyncIntrospect(host, port, client=client))
+                     for i in range(count)]
+            return sum(await asyncio.gather(*walks))
+        finally:
+            client.close()
+    # asyncio.run is Python 3.7+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(run())
+    finally:
+        loop.close()
@@ -0,0 +1,710 @@
+#!/usr/bin/env python
+"""
+Benchmarks for ist.py, run against synthetic introspect data.
+
+    python ist_bench.py xpath [--pages N] [--rows N] [--repeat N]
+    python ist_bench.py serve [--rows N] [--latency MS] [--bandwidth KBPS]
+                              [--gzip]
+    python ist_bench.py e2e [--rows N [N ...]] [--latency MS]
+                            [--bandwidth KBPS] [--gzip]
+    python ist_bench.py startup [--runs N] [--threshold MS]
+    python ist_bench.py fanout [--requests N [N ...]] [--latency MS]
+
+xpath first asserts that compile_xpath selects what uncached xpath()
+does and that its cache stays within XPath_Cache_Size, then times the
+collection of a next_batch walk.
+
+serve answers the introspect requests ist sends to a control node and a
+vrouter agent on their IntrospectPortMap ports, with documents generated
+on the fly, gzip compressed with --gzip when the client accepts it. The
+MB reported are the bytes sent on the wire.
+
+e2e starts that server and times ist commands against it, reporting
+throughput and peak RSS of each run.
+
+startup times short ist invocations and exits 1 when one takes more
+than --threshold ms over a bare interpreter.
+
+fanout holds N requests in flight at once, with a thread per request
+and with the asyncio client of ist_async.py (Python 3.6+), and reports
+their time and peak RSS.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+from lxml import etree
+
+import ist
+from ist import Introspect
+
+# Rows per next_batch or Pagination page, as sent by the daemons
+Batch_Size = 100
+Route_Table = 'default-domain:admin:blue:blue.inet.0'
+
+def route_page(page, rows, last):
+    """ one ShowRouteResp page of a next_batch walk """
+    routes = []
+    for i in range(rows):
+        n = page * rows + i
+        routes.append(
+            '<ShowRoute type="sandesh">'
+            '<prefix type="string">10.%d.%d.0/24</prefix>'
+            '<last_modified type="string">2018-Jun-01 12:34:00.000000'
+            '</last_modified>'
+            '<paths type="list"><list type="struct" size="1">'
+            '<ShowRoutePath type="sandesh">'
+            '<protocol type="string">XMPP</protocol>'
+            '<next_hop type="string">10.0.0.%d</next_hop>'
+            '<label type="u32">%d</label>'
+            '<origin_vn_path type="list"><list type="string" size="0">'
+            '</list></origin_vn_path>'
+            '<tunnel_encap type="list"><list type="string" size="2">'
+            '<element>gre</element><element>udp</element></list>'
+            '</tunnel_encap>'
+            '<communities type="list"><list type="string" size="1">'
+            '<element>no-reoriginate</element></list></communities>'
+            '</ShowRoutePath></list></paths></ShowRoute>'
+            % (n // 256 % 256, n % 256, n % 256, n))
+    batch = '' if last else \
+        '<next_batch link="ShowRouteReqIterate" type="string">x%d' \
+        '</next_batch>' % (page + 1)
+    return ('<ShowRouteResp type="sandesh"><tables type="list">'
+            '<list type="struct" size="1"><ShowRouteTable type="sandesh">'
+            '<routing_table_name type="string">blue.inet.0'
+            '</routing_table_name><routes type="list">'
+            '<list type="struct" size="%d">%s</list></routes>'
+            '</ShowRouteTable></list></tables>%s</ShowRouteResp>'
+            % (rows, ''.join(routes), batch))
+
+def leaf(tag, value, type='string'):
+    return '<%s type="%s">%s</%s>' % (tag, type, value, tag)
+
+def slist(name, chunks):
+    """ wrap the chunks of a response the way sandesh does """
+    yield ('<?xml-stylesheet type="text/xsl" href="/universal_parse.xsl"?>'
+           '<__%s_list type="slist">' % name)
+    for chunk in chunks:
+        yield chunk
+    yield '</__%s_list>' % name
+
+def ipv4(i):
+    return '10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255)
+
+def mac(i):
+    return '2:0:0:%x:%x:%x' % (i >> 16 & 255, i >> 8 & 255, i & 255)
+
+def timestamp(i):
+    return '2018-Jun-01 12:%02d:%02d.%06d' % (i // 60 % 60, i % 60, i)
+
+def ctr_path(i):
+    return ('<ShowRoutePath type="sandesh">' + leaf('protocol', 'XMPP') +
+            leaf('last_modified', timestamp(i)) +
+            leaf('local_preference', 100, 'i32') + leaf('med', 0, 'u32') +
+            leaf('peer_source_id', '0.0.0.0') + leaf('peer_router_id', '') +
+            leaf('source', 'vrouter%d' % (i % 64)) + leaf('as_path', '') +
+            leaf('next_hop', '10.0.%d.%d' % (i >> 8 & 63, i & 255)) +
+            leaf('label', 16 + i % 1000000, 'u32') +
+            leaf('replicated', 'false', 'bool') +
+            leaf('primary_table', Route_Table) +
+            '<secondary_tables type="list"><list type="string" size="0">'
+            '</list></secondary_tables>'
+            '<communities type="list"><list type="string" size="0"></list>'
+            '</communities>'
+            '<origin_vn type="string">default-domain:admin:blue</origin_vn>'
+            '<origin_vn_path type="list"><list type="string" size="0">'
+            '</list></origin_vn_path>'
+            '<tunnel_encap type="list"><list type="string" size="2">'
+            '<element>gre</element><element>udp</element></list>'
+            '</tunnel_encap>' + leaf('flags', '') +
+            leaf('sequence_no', '') + '</ShowRoutePath>')
+
+def ctr_route(i):
+    return ('<ShowRoute type="sandesh">' + leaf('prefix', ipv4(i) + '/32') +
+            leaf('last_modified', timestamp(i)) +
+            '<paths type="list"><list type="struct" size="1">' +
+            ctr_path(i) + '</list></paths></ShowRoute>')
+
+def ctr_route_page(start, rows):
+    """ Snh_ShowRouteReq: one table, Batch_Size routes per page chained by
+        next_batch """
+    end = min(start + Batch_Size, rows)
+    yield ('<ShowRouteResp type="sandesh"><tables type="list">'
+           '<list type="struct" size="1"><ShowRouteTable type="sandesh">' +
+           leaf('routing_instance', 'default-domain:admin:blue:blue') +
+           leaf('routing_table_name', Route_Table) +
+           leaf('deleted', 'false', 'bool') +
+           leaf('deleted_at', '') + leaf('prefixes', rows, 'u64') +
+           leaf('pending_updates', 0, 'u64') + leaf('paths', rows, 'u64') +
+           leaf('primary_paths', rows, 'u64') +
+           leaf('secondary_paths', 0, 'u64') +
+           leaf('infeasible_paths', 0, 'u64') +
+           '<routes type="list"><list type="struct" size="%d">' %
+           (end - start))
+    for i in range(start, end):
+        yield ctr_route(i)
+    yield ('</list></routes></ShowRouteTable></list></tables>'
+           '<next_batch type="string" link="ShowRouteReqIterate">%s'
+           '</next_batch></ShowRouteResp>' % (end if end < rows else ''))
+
+def bgp_neighbor(i):
+    return ('<BgpNeighborResp type="sandesh">' +
+            leaf('peer', 'vrouter%d' % i) + leaf('peer_address', ipv4(i)) +
+            leaf('peer_asn', 64512, 'u32') +
+            leaf('encoding', 'XMPP' if i else 'BGP') +
+            leaf('peer_type', 'internal') + leaf('state', 'Established') +
+            leaf('send_state', 'in sync') + leaf('flap_count', 0, 'u32') +
+            leaf('flap_time', '') + '</BgpNeighborResp>')
+
+def bgp_neighbor_page(start, rows):
+    """ Snh_BgpNeighborReq: Batch_Size peers per page chained by
+        next_batch """
+    end = min(start + Batch_Size, rows)
+    yield ('<BgpNeighborListResp type="sandesh"><neighbors type="list">'
+           '<list type="struct" size="%d">' % (end - start))
+    for i in range(start, end):
+        yield bgp_neighbor(i)
+    yield ('</list></neighbors>'
+           '<next_batch type="string" link="BgpNeighborReqIterate">%s'
+           '</next_batch></BgpNeighborListResp>' %
+           (end if end < rows else ''))
+
+def vr_route(i):
+    return ('<RouteUcSandeshData type="sandesh">' +
+            leaf('src_ip', ipv4(i)) + leaf('src_plen', 32, 'byte') +
+            leaf('src_vrf', 'default-domain:admin:blue:blue') +
+            '<path_list type="list"><list type="struct" size="1">'
+            '<PathSandeshData type="sandesh"><nh type="struct">'
+            '<NhSandeshData type="sandesh">' + leaf('type', 'interface') +
+            leaf('ref_count', 4, 'u32') + leaf('valid', 'true') +
+            leaf('policy', 'enabled') + leaf('itf', 'tap%08x' % i) +
+            leaf('mac', mac(i)) + leaf('nh_index', i, 'u32') +
+            '</NhSandeshData></nh>' + leaf('label', 16 + i, 'u32') +
+            leaf('vxlan_id', 0, 'u32') + leaf('peer', 'LocalVmPort') +
+            '<dest_vn_list type="list"><list type="string" size="1">'
+            '<element>default-domain:admin:blue</element></list>'
+            '</dest_vn_list>' + leaf('unresolved', 'false') +
+            leaf('active_label', 16 + i, 'u32') +
+            '<sg_list type="list"><list type="u32" size="0"></list>'
+            '</sg_list><path_preference_data type="struct">'
+            '<PathPreferenceSandeshData type="sandesh">' +
+            leaf('sequence', 0, 'u32') + leaf('preference', 200, 'u32') +
+            '</PathPreferenceSandeshData></path_preference_data>'
+            '<communities type="list"><list type="string" size="0"></list>'
+            '</communities></PathSandeshData></list></path_list>'
+            '</RouteUcSandeshData>')
+
+def itf(i):
+    return ('<ItfSandeshData type="sandesh">' + leaf('index', i, 'u32') +
+            leaf('name', 'tap%08x' % i) +
+            leaf('uuid', '00000000-0000-0000-0000-%012x' % i) +
+            leaf('vrf_name', 'default-domain:admin:blue:blue') +
+            leaf('active', 'Active') + leaf('dhcp_service', 'Enable') +
+            leaf('dns_service', 'Enable') + leaf('type', 'vport') +
+            leaf('label', 16 + i, 'u32') +
+            leaf('vn_name', 'default-domain:admin:blue') +
+            leaf('vm_uuid', '10000000-0000-0000-0000-%012x' % i) +
+            leaf('vm_name', 'vm%d' % i) + leaf('ip_addr', ipv4(i)) +
+            leaf('mac_addr', mac(i)) + leaf('policy', 'Enable') +
+            leaf('mdata_ip_addr', '169.254.%d.%d' % (i >> 8 & 255, i & 255)) +
+            leaf('mtu', 9160, 'u32') + leaf('os_ifindex', i, 'i32') +
+            '</ItfSandeshData>')
+
+def paginated(resp, list_name, record, start, end, rows, key):
+    """ a vrouter agent page of records [start, end). The first page
+        carries Pagination/req/PageReqData, whose 'all' key fetches the
+        whole table through Snh_PageReq. """
+    yield ('<%s type="sandesh"><%s type="list">'
+           '<list type="struct" size="%d">' % (resp, list_name, end - start))
+    for i in range(start, end):
+        yield record(i)
+    yield '</list></%s></%s>' % (list_name, resp)
+    if start == 0 and end < rows:
+        yield ('<Pagination type="sandesh"><req type="struct">'
+               '<PageReqData type="sandesh">' + leaf('prev_page', '') +
+               leaf('next_page', '%s %d %d' % (key, end, Batch_Size)) +
+               leaf('first_page', '%s 0 %d' % (key, Batch_Size)) +
+               leaf('all', '%s 0 %d' % (key, rows)) +
+               leaf('table_size', rows, 'u32') +
+               leaf('entries', '0-%d/%d' % (end - 1, rows)) +
+               '</PageReqData></req></Pagination>')
+
+class SyntheticData(object):
+    """ introspect documents of a control node and a vrouter agent, with
+        'rows' routes, neighbors and interfaces each """
+    agent_tables = {
+        'route': ('Inet4UcRouteResp', 'route_list', vr_route),
+        'itf': ('ItfResp', 'itf_list', itf),
+    }
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def agent_page(self, key, start, count):
+        resp, list_name, record = self.agent_tables[key]
+        end = min(start + count, self.rows)
+        return slist(resp, paginated(resp, list_name, record, start, end,
+                                     self.rows, key))
+
+    def document(self, name, query):
+        """ generator of the chunks of request 'name', None if unknown """
+        x = query.get('x', [''])[0]
+        if name == 'Snh_ShowRouteReq':
+            return slist('ShowRouteResp', ctr_route_page(0, self.rows))
+        if name == 'Snh_ShowRouteReqIterate':
+            return slist('ShowRouteResp', ctr_route_page(int(x), self.rows))
+        if name == 'Snh_BgpNeighborReq':
+            return slist('BgpNeighborListResp',
+                         bgp_neighbor_page(0, self.rows))
+        if name == 'Snh_BgpNeighborReqIterate':
+            return slist('BgpNeighborListResp',
+                         bgp_neighbor_page(int(x), self.rows))
+        if name == 'Snh_Inet4UcRouteReq':
+            return self.agent_page('route', 0, Batch_Size)
+        if name == 'Snh_ItfReq':
+            return self.agent_page('itf', 0, Batch_Size)
+        if name == 'Snh_PageReq':
+            key, start, count = x.split()
+            return self.agent_page(key, int(start), int(count))
+        return None
+
+class IntrospectServer(ThreadingMixIn, HTTPServer):
+    """ serves a SyntheticData, delaying each response by 'latency'
+        seconds and pacing the body to 'bandwidth' bytes per second.
+        With gzip, bodies are compressed for clients accepting it. """
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+    def __init__(self, port, data, latency=0, bandwidth=0, gzip=False):
+        HTTPServer.__init__(self, ('127.0.0.1', port), IntrospectHandler)
+        self.data = data
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.gzip = gzip
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes = 0
+
+class IntrospectHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        query = parse_qs(url.query, keep_blank_values=True)
+        chunks = server.data.document(url.path.lstrip('/'), query)
+        if chunks is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if server.latency:
+            time.sleep(server.latency)
+        compressor = None
+        if (server.gzip and
+                'gzip' in self.headers.get('Accept-Encoding', '')):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        if compressor:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        sent = 0
+        start = time.time()
+        buf = []
+        size = 0
+        for chunk in chunks:
+            buf.append(chunk)
+            size += len(chunk)
+            if size < 65536:
+                continue
+            sent += self.send_chunk(''.join(buf), compressor)
+            buf = []
+            size = 0
+            if server.bandwidth:
+                ahead = sent / float(server.bandwidth) - (time.time() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+        if buf or compressor:
+            sent += self.send_chunk(''.join(buf), compressor, True)
+        self.wfile.write(b'0\r\n\r\n')
+        with server.lock:
+            server.requests += 1
+            server.bytes += sent
+
+    def send_chunk(self, data, compressor=None, last=False):
+        data = data.encode('utf-8')
+        if compressor:
+            data = compressor.compress(data)
+            if last:
+                data += compressor.flush()
+            if not data:
+                return 0
+        self.wfile.write(('%x\r\n' % len(data)).encode('ascii'))
+        self.wfile.write(data + b'\r\n')
+        return len(data)
+
+def start_servers(rows, latency, bandwidth, port_offset=0, gzip=False):
+    """ control node and vrouter agent servers on their IntrospectPortMap
+        ports, each served from a background thread """
+    data = SyntheticData(rows)
+    servers = []
+    for service in ['contrail-control', 'contrail-vrouter-agent']:
+        port = ist.CLI_basic.IntrospectPortMap[service] + port_offset
+        server = IntrospectServer(port, data, latency, bandwidth, gzip)
+        t = threading.Thread(target=server.serve_forever)
+        t.daemon = True
+        t.start()
+        servers.append(server)
+    return servers
+
+def walk_baseline(trees, expr):
+    """ collection as printTbl did it: one list copy per page, the xpath
+        string and the per-path list xpaths re-compiled on every call """
+    items = []
+    for tree in trees:
+        items = items + tree.xpath(expr)
+    fields = Introspect.tblFields(items[0], [])
+    rows = [Introspect.tblRow(entry, fields) for entry in items]
+    for entry in items:
+        for path in entry.xpath('.//ShowRoutePath'):
+            str(path.xpath("origin_vn_path/list/element/text()"))
+            str(path.xpath("tunnel_encap/list/element/text()"))
+            str(path.xpath("communities/list/element/text()"))
+    return len(rows)
+
+def walk_current(trees, expr):
+    """ collection as renderTbl does it now """
+    IST = Introspect('localhost', 0, None)
+    IST.output_etree = trees
+    IST.tables = []
+    IST.renderTbl(expr, ist.Default_Max_Width, [], None)
+    for tree in trees:
+        for entry in ist.compile_xpath(expr)(tree):
+            for path in ist.compile_xpath('.//ShowRoutePath')(entry):
+                str(ist.compile_xpath(
+                    "origin_vn_path/list/element/text()")(path))
+                str(ist.compile_xpath(
+                    "tunnel_encap/list/element/text()")(path))
+                str(ist.compile_xpath(
+                    "communities/list/element/text()")(path))
+    return sum(len(rows) for fields, rows in IST.tables)
+
+def check_xpath(trees, expr):
+    """ assert that compiled xpaths select what tree.xpath does, that
+        renderTbl gets the rows of the baseline walk, and that the
+        compile_xpath cache stays within XPath_Cache_Size """
+    exprs = [expr, './/ShowRoutePath', 'string(prefix)',
+             "origin_vn_path/list/element/text()",
+             "tunnel_encap/list/element/text()"]
+    for tree in trees[:3]:
+        for e in exprs:
+            assert ist.compile_xpath(e)(tree) == tree.xpath(e), e
+        for entry in tree.xpath(expr)[:5]:
+            for e in exprs[1:]:
+                assert ist.compile_xpath(e)(entry) == entry.xpath(e), e
+
+    items = []
+    for tree in trees:
+        items.extend(tree.xpath(expr))
+    fields = Introspect.tblFields(items[0], [])
+    IST = Introspect('localhost', 0, None)
+    IST.output_etree = trees
+    IST.tables = []
+    IST.renderTbl(expr, ist.Default_Max_Width, [], None)
+    assert IST.tables[0] == (fields, [Introspect.tblRow(entry, fields)
+                                      for entry in items])
+
+    for i in range(ist.XPath_Cache_Size * 2 + 1):
+        ist.compile_xpath('//ShowRoute[%d]' % i)
+        assert len(ist.XPath_Cache) <= ist.XPath_Cache_Size
+    assert ist.compile_xpath(expr)(trees[0]) == trees[0].xpath(expr)
+
+def bench_xpath(args):
+    trees = [etree.fromstring(route_page(p, args.rows, p == args.pages - 1))
+             for p in range(args.pages)]
+    expr = '//ShowRoute'
+    print("%d pages of %d routes" % (args.pages, args.rows))
+    check_xpath(trees, expr)
+    results = {}
+    for name, walk in [('baseline', walk_baseline),
+                       ('current', walk_current)]:
+        best = None
+        for i in range(args.repeat):
+            start = time.time()
+            count = walk(trees, expr)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results[name] = best
+        print("%-10s %8.3f s  %d rows" % (name, best, count))
+    print("speedup    %8.2fx" % (results['baseline'] / results['current']))
+
+def serve(args):
+    servers = start_servers(args.rows, args.latency / 1000.0,
+                            args.bandwidth * 1024, args.port_offset,
+                            args.gzip)
+    print("serving %d rows on ports %s" %
+          (args.rows, ', '.join(str(s.server_address[1]) for s in servers)))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+# End to end cases: name, ist role and command, role port, rows per run
+Cases = [
+    ('get', None, 'contrail-control'),
+    ('printTbl ctr nei', ['ctr', 'nei'], 'contrail-control'),
+    ('printTbl vr intf', ['vr', 'intf'], 'contrail-vrouter-agent'),
+    ('showRoute_CTR', ['ctr', 'route', 'show'], 'contrail-control'),
+    ('showRoute_VR', ['vr', 'route', '-v', '1'], 'contrail-vrouter-agent'),
+]
+
+def get_pages(args):
+    """ Introspect.get alone: walk the pages of a request """
+    IST = Introspect('127.0.0.1', args.port, None)
+    IST.get(args.path, stream=True)
+    pages = 0
+    for tree in IST.output_etree:
+        pages += 1
+    IST.close()
+    print("%d pages" % pages)
+
+def run_case(cmd, quiet=False):
+    """ run cmd in a child process, returns its (seconds, peak RSS KB).
+        With quiet, its stderr is discarded too. """
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+        child = subprocess.Popen(cmd, stdout=devnull,
+                                 stderr=devnull if quiet else None)
+        pid, status, rusage = os.wait4(child.pid, 0)
+    elapsed = time.time() - start
+    if status:
+        raise RuntimeError("%s exited with %d" % (' '.join(cmd), status))
+    return elapsed, rusage.ru_maxrss
+
+def e2e(args):
+    here = os.path.dirname(os.path.abspath(__file__))
+    fields = ['case', 'rows', 'seconds', 'rows/s', 'MB', 'MB/s',
+              'peak RSS MB']
+    results = []
+    for rows in args.rows:
+        servers = start_servers(rows, args.latency / 1000.0,
+                                args.bandwidth * 1024, args.port_offset,
+                                args.gzip)
+        for name, command, service in Cases:
+            port = str(ist.CLI_basic.IntrospectPortMap[service] +
+                       args.port_offset)
+            if command is None:
+                cmd = [sys.executable, os.path.join(here, 'ist_bench.py'),
+                       'get', '--port', port, 'Snh_ShowRouteReq']
+            else:
+                cmd = [sys.executable, os.path.join(here, 'ist.py'),
+                       '--host', '127.0.0.1', '--port', port] + command
+            before = sum(s.bytes for s in servers)
+            elapsed, rss = run_case(cmd)
+            served = (sum(s.bytes for s in servers) - before) / 1e6
+            results.append([name, rows, '%.2f' % elapsed,
+                            '%d' % (rows / elapsed), '%.1f' % served,
+                            '%.1f' % (served / elapsed),
+                            '%.1f' % (rss / 1024.0)])
+            print(' '.join(str(c) for c in results[-1]))
+            sys.stdout.flush()
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+    tbl = Introspect.newTbl(fields, 30)
+    for row in results:
+        tbl.add_row(row)
+    print(tbl)
+
+def fanout_run(args):
+    """ get Snh_BgpNeighborReq args.requests times at once """
+    if args.mode == 'threads':
+        def worker():
+            IST = Introspect('127.0.0.1', args.port, None)
+            IST.get('Snh_BgpNeighborReq')
+            IST.close()
+        threads = [threading.Thread(target=worker)
+                   for i in range(args.requests)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    else:
+        # py3 only, so kept out of this module
+        import ist_async
+        ist_async.fanout('127.0.0.1', args.port, 'Snh_BgpNeighborReq',
+                         args.requests)
+
+def fanout(args):
+    here = os.path.dirname(os.path.abspath(__file__))
+    servers = start_servers(args.rows, args.latency / 1000.0, 0,
+                            args.port_offset, args.gzip)
+    port = str(servers[0].server_address[1])
+    modes = ['threads']
+    if sys.version_info >= (3, 6):
+        modes.append('async')
+    fields = ['engine', 'requests', 'seconds', 'requests/s', 'peak RSS MB']
+    tbl = Introspect.newTbl(fields, 30)
+    for requests in args.requests:
+        for mode in modes:
+            elapsed, rss = run_case([sys.executable,
+                                     os.path.join(here, 'ist_bench.py'),
+                                     'fanout-run', '--mode', mode,
+                                     '--port', port,
+                                     '--requests', str(requests)])
+            tbl.add_row([mode, requests, '%.2f' % elapsed,
+                         '%d' % (requests / elapsed), '%.1f' % (rss / 1024.0)])
+    print(tbl)
+
+def startup_times(runs):
+    """ median ms of each short ist run, and of a bare interpreter """
+    here = os.path.dirname(os.path.abspath(__file__))
+    tiny = tempfile.NamedTemporaryFile(suffix='.xml', delete=False)
+    tiny.write(''.join(SyntheticData(3).document('Snh_PageReq',
+                                                 {'x': ['itf 0 3']}))
+               .encode('utf-8'))
+    tiny.close()
+    cases = [
+        ('python', None),
+        ('usage', []),
+        ('role help', ['vr', '-h']),
+        ('command help', ['ctr', 'nei', '-h']),
+        ('3 rows from --file', ['--file', tiny.name, 'vr', 'intf']),
+    ]
+    medians = []
+    try:
+        for name, command in cases:
+            if command is None:
+                cmd = [sys.executable, '-c', 'pass']
+            else:
+                cmd = [sys.executable, os.path.join(here, 'ist.py')] + command
+            times = sorted(run_case(cmd, quiet=True)[0]
+                           for i in range(runs))
+            medians.append((name, times[len(times) // 2] * 1000))
+    finally:
+        os.unlink(tiny.name)
+    return medians
+
+def startup(args):
+    """ fails when ist takes more than args.threshold ms over the bare
+        interpreter to start, so that a loaded host does not fail it """
+    medians = startup_times(args.runs)
+    python = medians[0][1]
+    slow = []
+    for name, median in medians:
+        over = median - python
+        if name != 'python' and over > args.threshold:
+            slow.append(name)
+        print("%-20s %7.1f ms%s" % (name, median,
+                                    '' if name == 'python' else
+                                    '  (+%.1f ms)%s' % (
+                                        over, '  SLOWER THAN +%d ms' %
+                                        args.threshold if name in slow
+                                        else '')))
+    if slow:
+        sys.stderr.write("FAILED: %s over the %d ms startup budget\n" %
+                         (', '.join(slow), args.threshold))
+        sys.exit(1)
+
+def main():
+    parser = argparse.ArgumentParser(prog='ist_bench',
+                                     description='ist.py micro-benchmarks')
+    subparsers = parser.add_subparsers()
+    subp = subparsers.add_parser('xpath',
+                                 help='XPath collection over a next_batch walk')
+    subp.add_argument('--pages', type=int, default=500, help='Page count')
+    subp.add_argument('--rows', type=int, default=100,
+                      help='Routes per page')
+    subp.add_argument('--repeat', type=int, default=3,
+                      help='Runs per variant, best one is reported')
+    subp.set_defaults(func=bench_xpath)
+
+    def server_args(subp):
+        subp.add_argument('--latency', type=float, default=0,
+                          help='Delay before each response, in ms')
+        subp.add_argument('--bandwidth', type=int, default=0,
+                          help='Response rate limit in KB/s, 0 for none')
+        subp.add_argument('--port-offset', type=int, default=0,
+                          help='Added to the IntrospectPortMap ports')
+        subp.add_argument('--gzip', action='store_true',
+                          help='Compress responses for clients accepting '
+                               'gzip')
+
+    subp = subparsers.add_parser('serve',
+                                 help='Serve synthetic introspect data')
+    subp.add_argument('--rows', type=int, default=10000,
+                      help='Routes, neighbors and interfaces served')
+    server_args(subp)
+    subp.set_defaults(func=serve)
+
+    subp = subparsers.add_parser('e2e',
+                                 help='Time ist commands end to end')
+    subp.add_argument('--rows', type=int, nargs='+',
+                      default=[10000, 100000, 1000000],
+                      help='Data sizes to run')
+    server_args(subp)
+    subp.set_defaults(func=e2e)
+
+    subp = subparsers.add_parser('startup',
+                                 help='Time the startup of short ist runs')
+    subp.add_argument('--runs', type=int, default=9,
+                      help='Runs per case, the median is reported')
+    subp.add_argument('--threshold', type=int, default=250,
+                      help='Fail when a median exceeds the bare '
+                           'interpreter by this many ms')
+    subp.set_defaults(func=startup)
+
+    subp = subparsers.add_parser('fanout',
+                                 help='Many requests in flight, threads '
+                                      'against asyncio')
+    subp.add_argument('--requests', type=int, nargs='+',
+                      default=[100, 1000],
+                      help='Requests in flight')
+    subp.add_argument('--rows', type=int, default=50,
+                      help='Neighbors per response')
+    server_args(subp)
+    subp.set_defaults(func=fanout)
+
+    subp = subparsers.add_parser('fanout-run',
+                                 help='Requests of one fanout case')
+    subp.add_argument('--mode', choices=['threads', 'async'], required=True)
+    subp.add_argument('--port', type=int, required=True)
+    subp.add_argument('--requests', type=int, required=True)
+    subp.set_defaults(func=fanout_run)
+
+    subp = subparsers.add_parser('get', help='Walk the pages of a request')
+    subp.add_argument('--port', type=int, required=True)
+    subp.add_argument('path', help='Request path, e.g. Snh_ShowRouteReq')
+    subp.set_defaults(func=get_pages)
+
+    args = parser.parse_args()
+    if 'func' not in args:
+        parser.print_usage()
+        sys.exit(1)
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
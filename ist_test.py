@@ -0,0 +1,1035 @@
+#!/usr/bin/env python
+"""
+Checks of ist.py against the synthetic introspect servers of ist_bench.py.
+
+    python ist_test.py
+    python -m pytest ist_test.py
+
+The servers listen on the IntrospectPortMap ports plus Port_Offset, one
+set sending plain and one gzip compressed responses. Each check compares
+what ist computes with a straightforward reference, or asserts a limit
+ist must keep.
+"""
+
+import argparse
+import copy
+import csv
+import gzip
+import io
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import zlib
+from collections import OrderedDict
+from datetime import datetime
+
+from lxml import etree
+
+import ist
+import ist_bench
+from ist import Introspect, IntrospectError, PrefixIndex
+
+Port_Offset = 31000
+Gzip_Offset = 31100
+Prefetch_Offset = 31200
+Rows = 250
+# startup budget over a bare interpreter, as ist_bench.py startup
+Startup_Threshold = 250
+
+def setUpModule():
+    global servers
+    servers = (ist_bench.start_servers(Rows, 0, 0, Port_Offset) +
+               ist_bench.start_servers(Rows, 0, 0, Gzip_Offset, gzip=True))
+
+def tearDownModule():
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+def port(service, offset=Port_Offset):
+    return ist.CLI_basic.IntrospectPortMap[service] + offset
+
+def rows(trees, expr):
+    """ (fields, rows) of the expr records of trees, as printTbl builds
+        them """
+    items = [item for tree in trees for item in tree.xpath(expr)]
+    fields = Introspect.tblFields(items[0], [])
+    return fields, [Introspect.tblRow(item, fields) for item in items]
+
+def serialized(trees):
+    return [etree.tostring(tree) for tree in trees]
+
+def captured(func, *args):
+    """ result of func(*args) and what it printed """
+    printed = []
+    stdout = sys.stdout
+    sys.stdout = ist.ThreadOutput(stdout)
+    sys.stdout.capture(printed)
+    try:
+        return func(*args), ''.join(printed)
+    finally:
+        sys.stdout.capture(None)
+        sys.stdout = stdout
+
+
+class PagesTest(unittest.TestCase):
+    """ Introspect.get pagination """
+    def get(self, service, path, offset=Port_Offset, stream=False):
+        IST = Introspect('127.0.0.1', port(service, offset), None)
+        try:
+            IST.get(path, stream)
+            return list(IST.output_etree)
+        finally:
+            IST.close()
+
+    def test_next_batch(self):
+        trees = self.get('contrail-control', 'Snh_BgpNeighborReq')
+        self.assertEqual(len(trees), (Rows + ist_bench.Batch_Size - 1) //
+                         ist_bench.Batch_Size)
+        fields, table = rows(trees, '//BgpNeighborResp')
+        self.assertEqual([row[fields.index('peer')] for row in table],
+                         ['vrouter%d' % i for i in range(Rows)])
+
+    def test_page_req_all(self):
+        # the first page is replaced by its Snh_PageReq 'all' page
+        trees = self.get('contrail-vrouter-agent', 'Snh_ItfReq')
+        self.assertEqual(len(trees), 1)
+        fields, table = rows(trees, '//ItfSandeshData')
+        self.assertEqual([row[fields.index('index')] for row in table],
+                         [str(i) for i in range(Rows)])
+
+    def test_stream(self):
+        self.assertEqual(
+            serialized(self.get('contrail-control', 'Snh_ShowRouteReq')),
+            serialized(self.get('contrail-control', 'Snh_ShowRouteReq',
+                                stream=True)))
+
+    def test_gzip(self):
+        plain, compressed = servers[0], servers[2]
+        before = plain.bytes, compressed.bytes
+        self.assertEqual(
+            serialized(self.get('contrail-control', 'Snh_ShowRouteReq')),
+            serialized(self.get('contrail-control', 'Snh_ShowRouteReq',
+                                Gzip_Offset)))
+        sent = plain.bytes - before[0], compressed.bytes - before[1]
+        # synthetic routes compress well, sandesh pages do too
+        self.assertLess(sent[1] * 4, sent[0])
+
+    @unittest.skipIf(sys.version_info < (3, 6), 'needs Python 3.6+')
+    def test_async_engine(self):
+        expected = serialized(self.get('contrail-control',
+                                       'Snh_ShowRouteReq', Gzip_Offset))
+        ist.engine = ist.async_engine()
+        try:
+            self.assertEqual(
+                serialized(self.get('contrail-control', 'Snh_ShowRouteReq',
+                                    Gzip_Offset)), expected)
+        finally:
+            ist.engine.close()
+            ist.engine = None
+
+    @unittest.skipIf(sys.version_info < (3, 6), 'needs Python 3.6+')
+    def test_async_fanout(self):
+        import ist_async
+        pages = (Rows + ist_bench.Batch_Size - 1) // ist_bench.Batch_Size
+        self.assertEqual(ist_async.fanout('127.0.0.1',
+                                          port('contrail-control'),
+                                          'Snh_BgpNeighborReq', 5),
+                         5 * pages)
+
+    def test_keep_alive(self):
+        # every page of a walk goes over one pooled connection
+        IST = Introspect('127.0.0.1', port('contrail-control'), None)
+        IST.get('Snh_BgpNeighborReq')
+        pools = IST.session.adapters['http://'].poolmanager.pools
+        pool = pools[list(pools.keys())[0]]
+        self.assertEqual(len(IST.output_etree), 3)
+        self.assertEqual(pool.num_connections, 1)
+        self.assertEqual(pool.num_requests, 3)
+        IST.close()
+
+    def test_not_found(self):
+        self.assertRaises(IntrospectError, self.get, 'contrail-control',
+                          'Snh_NoSuchReq')
+
+
+class XPathTest(unittest.TestCase):
+    def test_compile_xpath(self):
+        trees = [etree.fromstring(ist_bench.route_page(p, 50, p == 4))
+                 for p in range(5)]
+        ist_bench.check_xpath(trees, '//ShowRoute')
+
+
+class KeyedRowsTest(unittest.TestCase):
+    def test_natural_key(self):
+        fields = ['state', 'peer', 'name']
+        rows = [['up', 'b', 'x'], ['up', 'a', 'y'], ['down', 'b', 'z']]
+        keyed = ist.keyed_rows(fields, rows)
+        self.assertEqual(list(keyed), [('b', 0), ('a', 0), ('b', 1)])
+        self.assertEqual(list(keyed.values()), rows)
+
+    def test_first_column(self):
+        keyed = ist.keyed_rows(['x', 'y'], [['1', 'a'], ['1', 'b']])
+        self.assertEqual(list(keyed), [('1', 0), ('1', 1)])
+
+    def test_poll_diff(self):
+        # the rows watch sees change between two polls of the server
+        fields, before = rows(
+            [etree.fromstring(''.join(ist_bench.bgp_neighbor_page(0, 5)))],
+            '//BgpNeighborResp')
+        after = [list(row) for row in before[1:]]
+        after[0][fields.index('state')] = 'Idle'
+        old = ist.keyed_rows(fields, before)
+        new = ist.keyed_rows(fields, after)
+        self.assertEqual([k for k in old if k not in new], [('vrouter0', 0)])
+        self.assertEqual([k for k in new if old.get(k) != new[k]],
+                         [('vrouter1', 0)])
+
+
+class RunHostsTest(unittest.TestCase):
+    class CLI(object):
+        """ handler returning a table whose fields depend on the host """
+        Tables = {
+            'old': (['peer', 'state'], [['a', 'up']]),
+            'new': (['peer', 'flaps', 'state'], [['b', '2', 'down']]),
+        }
+
+        def __init__(self, host=None):
+            self.host = host
+            self.IST = Introspect('localhost', 0, None)
+
+        def for_host(self, host):
+            return RunHostsTest.CLI(host)
+
+        def show(self, args):
+            if args.format == 'table':
+                self.IST.tables.append(self.Tables[self.host])
+                return
+            writer = ist.RecordWriter(args.format, self.IST.records)
+            fields, rows = self.Tables[self.host]
+            for row in rows:
+                if args.format == 'csv':
+                    writer.write(row, fields)
+                else:
+                    writer.write(OrderedDict(zip(fields, row)))
+            writer.close()
+
+    def run_hosts(self, format):
+        args = type('Args', (), {'func': self.CLI().show,
+                                 'format': format})()
+        failed, text = captured(ist.run_hosts, args, ['old', 'new'])
+        self.assertEqual(failed, [])
+        return text
+
+    def test_merged_fields(self):
+        lines = [[c.strip() for c in line.split('|')[1:-1]]
+                 for line in self.run_hosts('table').splitlines()
+                 if line.startswith('|')]
+        self.assertEqual(lines, [['host', 'peer', 'state', 'flaps'],
+                                 ['old', 'a', 'up', ''],
+                                 ['new', 'b', 'down', '2']])
+
+    def test_merged_records(self):
+        records = [{'host': 'old', 'peer': 'a', 'state': 'up'},
+                   {'host': 'new', 'peer': 'b', 'flaps': '2',
+                    'state': 'down'}]
+        self.assertEqual(json.loads(self.run_hosts('json')), records)
+        self.assertEqual([json.loads(line) for line in
+                          self.run_hosts('ndjson').splitlines()], records)
+        self.assertEqual(list(csv.reader(io.StringIO(
+            u'' + self.run_hosts('csv')))),
+            [['host', 'peer', 'state', 'flaps'],
+             ['old', 'a', 'up', ''], ['new', 'b', 'down', '2']])
+
+
+class RecordWriterTest(unittest.TestCase):
+    records = [OrderedDict([('peer', 'a'), ('state', 'up')]),
+               OrderedDict([('peer', 'b,c'), ('state', None)])]
+
+    def write(self, format):
+        def run():
+            writer = ist.RecordWriter(format)
+            for record in self.records:
+                if format == 'csv':
+                    writer.write(list(record.values()), list(record))
+                else:
+                    writer.write(record)
+            writer.close()
+        return captured(run)[1]
+
+    def test_json(self):
+        self.assertEqual(json.loads(self.write('json')), self.records)
+        writer = ist.RecordWriter('json')
+        self.assertEqual(captured(writer.close)[1], '[]\n')
+
+    def test_ndjson(self):
+        self.assertEqual(self.write('ndjson'),
+                         '{"peer": "a", "state": "up"}\n'
+                         '{"peer": "b,c", "state": null}\n')
+
+    def test_csv(self):
+        self.assertEqual(self.write('csv'), 'peer,state\na,up\n"b,c",\n')
+
+    def test_collected(self):
+        records = []
+        writer = ist.RecordWriter('csv', records)
+        self.assertEqual(captured(writer.write, ['a'], ['peer'])[1], '')
+        self.assertEqual(records, [(['a'], ['peer'])])
+
+
+class CollectTest(unittest.TestCase):
+    """ tables of the handlers printing their own table, as --watch and
+        --hosts collect them """
+    Static = ('<ShowStaticRouteResp><static_route_entries><list>' +
+              ''.join('<StaticRouteEntriesInfo><ri_name>%s</ri_name>'
+                      '<static_route_list><list>%s</list></static_route_list>'
+                      '</StaticRouteEntriesInfo>' % (ri, ''.join(
+                          '<StaticRouteInfo><prefix>%s</prefix>'
+                          '<nexthop>%s</nexthop></StaticRouteInfo>' % route
+                          for route in routes))
+                      for ri, routes in [
+                          ('ri-a', [('1.1.1.0/24', '10.0.0.1')]),
+                          ('ri-b', [('2.2.2.0/24', '10.0.0.2'),
+                                    ('3.3.3.0/24', '10.0.0.3')])]) +
+              '</list></static_route_entries></ShowStaticRouteResp>')
+
+    def test_static_route(self):
+        IST = Introspect('localhost', 0, None)
+        IST.output_etree = [etree.fromstring(self.Static)]
+        IST.tables = []
+        IST.showStaticRoute('//StaticRouteEntriesInfo', 'table', None, None)
+        self.assertEqual(IST.tables, [(
+            ['ri_name', 'prefix', 'nexthop'],
+            [['ri-a', '1.1.1.0/24', '10.0.0.1'],
+             ['ri-b', '2.2.2.0/24', '10.0.0.2'],
+             ['ri-b', '3.3.3.0/24', '10.0.0.3']])])
+
+    def test_static_route_text(self):
+        # each routing instance lists its own routes only
+        IST = Introspect('localhost', 0, None)
+        IST.output_etree = [etree.fromstring(self.Static)]
+        text = captured(IST.showStaticRoute, '//StaticRouteEntriesInfo',
+                        'table', None, None)[1]
+        ri_a, ri_b = text.split('ri_name: ri-b\n')
+        self.assertTrue(ri_a.startswith('ri_name: ri-a\n'))
+        self.assertEqual([l.split()[1] for l in ri_a.splitlines()
+                          if '.0/24' in l], ['1.1.1.0/24'])
+        self.assertEqual([l.split()[1] for l in ri_b.splitlines()
+                          if '.0/24' in l], ['2.2.2.0/24', '3.3.3.0/24'])
+
+
+class DecodeContentTest(unittest.TestCase):
+    data = b''.join(s.encode('utf-8')
+                    for s in ist_bench.bgp_neighbor_page(0, 20))
+
+    def test_encodings(self):
+        out = io.BytesIO()
+        with gzip.GzipFile(fileobj=out, mode='wb') as f:
+            f.write(self.data)
+        deflate = zlib.compressobj(6, zlib.DEFLATED, -15)
+        raw = deflate.compress(self.data) + deflate.flush()
+        for encoding, body in [(None, self.data),
+                               ('identity', self.data),
+                               ('gzip', out.getvalue()),
+                               ('GZIP', out.getvalue()),
+                               ('deflate', zlib.compress(self.data)),
+                               ('deflate', raw)]:
+            self.assertEqual(ist.decode_content(body, encoding), self.data)
+
+    def test_corrupt(self):
+        for encoding in ['gzip', 'deflate']:
+            self.assertRaises(IntrospectError, ist.decode_content,
+                              self.data, encoding, 'http://x/')
+
+
+class TimestampTest(unittest.TestCase):
+    def test_strptime(self):
+        stamps = [ist_bench.timestamp(i) for i in range(0, 200000, 997)]
+        stamps += ['2018-Dec-31 23:59:59.5', '2018-Jan-01 00:00:00',
+                   '2018-Feb-28 01:02:03.000001']
+        for s in stamps:
+            for i in range(2):
+                # parsed, then from Timestamp_Cache
+                self.assertEqual(ist.parse_timestamp(s),
+                                 datetime.strptime(
+                                     s if '.' in s else s + '.0',
+                                     '%Y-%b-%d %H:%M:%S.%f'))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, ist.parse_timestamp, 'yesterday')
+
+    def test_cache_bound(self):
+        for i in range(ist.Timestamp_Cache_Size * 2):
+            ist.parse_timestamp('2018-Jun-01 %02d:%02d:%02d.1' %
+                                (i // 3600 % 24, i // 60 % 60, i % 60))
+            self.assertLessEqual(len(ist.Timestamp_Cache),
+                                 ist.Timestamp_Cache_Size)
+
+
+class PrefixIndexTest(unittest.TestCase):
+    def longest(self, routes, family, addr):
+        """ reference longest prefix match, by masking each prefix """
+        af, bits = ((socket.AF_INET6, 128) if family == 'inet6'
+                    else (socket.AF_INET, 32))
+        value = lambda a: int(''.join('%02x' % c for c in bytearray(
+            socket.inet_pton(af, a))), 16)
+        chain = []
+        for prefix, route in routes:
+            net, plen = prefix.split('/')
+            shift = bits - int(plen)
+            if value(net) >> shift == value(addr) >> shift:
+                chain.append((int(plen), route))
+        return [route for plen, route in sorted(chain)]
+
+    def check(self, family, routes, addrs):
+        index = PrefixIndex(family)
+        for prefix, route in routes:
+            index.insert(prefix, route)
+        for addr in addrs:
+            self.assertEqual(index.lookup(addr),
+                             self.longest(routes, family, addr), addr)
+            self.assertEqual(
+                [p for p, r in routes
+                 if index.covers(p, index.address(addr)) is not None],
+                [p for p, r in routes
+                 if r in self.longest(routes, family, addr)])
+
+    def test_inet(self):
+        # the vrouter host routes of the synthetic agent, and covering
+        # prefixes of every length
+        trees = [etree.fromstring(''.join(
+            ist_bench.SyntheticData(Rows).agent_page('route', 0, Rows)))]
+        fields, table = rows(trees, '//RouteUcSandeshData')
+        src_ip, src_plen = fields.index('src_ip'), fields.index('src_plen')
+        routes = [('%s/%s' % (row[src_ip], row[src_plen]), row[src_ip])
+                  for row in table]
+        routes += [('10.0.0.0/%d' % plen, 'len%d' % plen)
+                   for plen in range(8, 32, 3)]
+        routes += [('0.0.0.0/0', 'default')]
+        self.check('inet', routes,
+                   ['10.0.0.0', '10.0.0.7', '10.0.0.%d' % (Rows - 1),
+                    '10.0.1.0', '10.1.0.0', '192.168.0.1'])
+
+    def test_inet6(self):
+        routes = [('2001:db8::/32', 'a'), ('2001:db8:1::/48', 'b'),
+                  ('2001:db8:1::1/128', 'c'), ('::/0', 'default')]
+        self.check('inet6', routes, ['2001:db8:1::1', '2001:db8:1::2',
+                                     '2001:db8:2::1', 'fe80::1'])
+
+    def test_invalid_prefix(self):
+        index = PrefixIndex('inet')
+        index.insert('10.0.0.0', 'no length')
+        index.insert('10.0.0.x/8', 'bad address')
+        self.assertEqual(index.lookup('10.0.0.1'), [])
+        self.assertIsNone(index.covers('10.0.0.x/8', 0))
+
+
+class RecordsTest(unittest.TestCase):
+    """ iter_records renders each record of a --file like the whole
+        document does """
+    def check(self, data, tag, header):
+        f = tempfile.NamedTemporaryFile(suffix='.xml')
+        f.write(''.join(data).encode('utf-8'))
+        f.flush()
+        IST = Introspect('localhost', 0, f.name)
+        whole = etree.parse(f.name)
+        streamed = []
+        for tree in IST.iter_records(tag):
+            self.assertEqual(len(tree.xpath('//' + tag)), 1)
+            if header:
+                # the fields before the records come along
+                self.assertEqual(tree.xpath(header), whole.xpath(header))
+            streamed.append(copy.deepcopy(tree))
+        f.close()
+        self.assertEqual(rows(streamed, '//' + tag),
+                         rows([whole], '//' + tag))
+
+    def test_routes(self):
+        # three route tables, as pages of one table would be in a file
+        data = ist_bench.slist('ShowRouteResp', [
+            chunk for start in range(0, Rows, ist_bench.Batch_Size)
+            for chunk in ist_bench.ctr_route_page(start, Rows)])
+        self.check(data, 'ShowRoute', 'string(//routing_table_name)')
+
+    def test_interfaces(self):
+        self.check(ist_bench.SyntheticData(Rows).agent_page('itf', 0, Rows),
+                   'ItfSandeshData', None)
+
+    def test_skeleton(self):
+        doc = etree.fromstring('<a x="1"><h>head</h><b><r>1</r><r>2</r>'
+                               '<t>tail</t></b></a>')
+        record = doc.find('b/r')
+        tree, parent = Introspect.recordSkeleton(
+            record, list(record.iterancestors()))
+        self.assertEqual(etree.tostring(tree), b'<a x="1"><h>head</h><b/></a>')
+        self.assertEqual(parent.tag, 'b')
+
+
+class SchedulerTest(unittest.TestCase):
+    class Response(object):
+        def __init__(self, status_code):
+            self.status_code = status_code
+
+    def run_requests(self, scheduler, count, delay, status=200):
+        """ count requests at once, each taking delay seconds. Returns
+            the most requests seen in flight. """
+        lock = threading.Lock()
+        state = {'active': 0, 'max': 0}
+
+        def get():
+            with lock:
+                state['active'] += 1
+                state['max'] = max(state['max'], state['active'])
+            time.sleep(delay)
+            with lock:
+                state['active'] -= 1
+            return self.Response(status)
+
+        threads = [threading.Thread(target=scheduler.request,
+                                    args=('host', 'Snh_ItfReq', get))
+                   for i in range(count)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return state['max']
+
+    def test_per_host(self):
+        scheduler = ist.Scheduler(per_host=3)
+        self.assertEqual(self.run_requests(scheduler, 12, 0.05), 3)
+        self.assertEqual(scheduler.hosts['host']['active'], 0)
+
+    def test_backoff(self):
+        scheduler = ist.Scheduler(per_host=8)
+        self.run_requests(scheduler, 4, 0.01, 503)
+        self.assertLess(scheduler.hosts['host']['limit'], 8)
+        self.assertGreaterEqual(scheduler.hosts['host']['limit'], 1)
+        # fast responses raise it back
+        for i in range(200):
+            self.run_requests(scheduler, 1, 0)
+        self.assertEqual(scheduler.hosts['host']['limit'], 8)
+
+    def test_slow(self):
+        scheduler = ist.Scheduler(per_host=8)
+        self.run_requests(scheduler, 1, 0.06)
+        self.run_requests(scheduler, 1, 0.06 * 4)
+        self.assertEqual(scheduler.hosts['host']['limit'], 4)
+
+    def test_rate(self):
+        scheduler = ist.Scheduler(per_host=100, rate=50)
+        start = time.time()
+        self.run_requests(scheduler, 80, 0)
+        # a burst of 50 tokens, then one every 1/50 s
+        self.assertGreaterEqual(time.time() - start, 30 / 50.0 * 0.9)
+
+    def test_load_aware(self):
+        scheduler = ist.Scheduler(per_host=4, load_aware=True)
+        probes = []
+
+        def probe():
+            probes.append(1)
+            return 2.0
+        get = lambda: self.Response(200)
+        for i in range(5):
+            scheduler.request('host', 'Snh_ItfReq', get, probe)
+        self.assertEqual(len(probes), 1)
+        self.assertEqual(scheduler.limit(scheduler.hosts['host']), 1)
+
+
+class SingleFlightTest(unittest.TestCase):
+    def concurrent(self, flights, func, count=8):
+        """ results or exceptions of count concurrent flights.do calls """
+        results = []
+        lock = threading.Lock()
+
+        def call():
+            try:
+                result = flights.do('key', func)
+            except Exception as e:
+                result = e
+            with lock:
+                results.append(result)
+        threads = [threading.Thread(target=call) for i in range(count)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+    def test_coalesced(self):
+        calls = []
+
+        def func():
+            calls.append(1)
+            time.sleep(0.2)
+            return 'page'
+        flights = ist.SingleFlight(60)
+        results = self.concurrent(flights, func)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(how for result, how in results),
+                         ['coalesced'] * 7 + ['miss'])
+        self.assertEqual(set(result for result, how in results), {'page'})
+        self.assertEqual(flights.do('key', func), ('page', 'hit'))
+        self.assertEqual(len(calls), 1)
+
+    def test_error(self):
+        calls = []
+
+        def func():
+            calls.append(1)
+            time.sleep(0.2)
+            raise IntrospectError('down')
+        flights = ist.SingleFlight(60)
+        results = self.concurrent(flights, func)
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(all(isinstance(r, IntrospectError) for r in results))
+        # errors are not kept
+        self.assertRaises(IntrospectError, flights.do, 'key', func)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(flights.flights, {})
+
+    def test_keep_and_ttl(self):
+        flights = ist.SingleFlight(0.1)
+        self.assertEqual(flights.do('a', lambda: 1, lambda r: False),
+                         (1, 'miss'))
+        self.assertEqual(flights.do('a', lambda: 2), (2, 'miss'))
+        self.assertEqual(flights.do('a', lambda: 3), (2, 'hit'))
+        time.sleep(0.15)
+        self.assertEqual(flights.do('a', lambda: 4), (4, 'miss'))
+
+
+class StartupTest(unittest.TestCase):
+    def test_threshold(self):
+        medians = ist_bench.startup_times(3)
+        python = medians[0][1]
+        for name, median in medians[1:]:
+            self.assertLess(median - python, Startup_Threshold, name)
+
+
+class PageCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = ist.PageCache(60, self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def age(self, url, seconds):
+        """ make the page of url look written 'seconds' ago """
+        stamp = time.time() - seconds
+        os.utime(self.cache.filename(url), (stamp, stamp))
+
+    def test_ttl(self):
+        self.cache.put('http://a/1', b'page')
+        self.assertEqual(self.cache.get('http://a/1'), b'page')
+        self.assertIsNone(self.cache.get('http://a/2'))
+        self.age('http://a/1', 61)
+        self.assertIsNone(self.cache.get('http://a/1'))
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+
+    def test_owner(self):
+        # pages of another user are not read
+        self.cache.put('http://a/1', b'page')
+        other = ist.PageCache(60, self.directory)
+        other.uid = (self.cache.uid or 0) + 1
+        self.assertIsNone(other.get('http://a/1'))
+
+    def test_prune(self):
+        self.cache.put('http://a/1', b'old')
+        self.age('http://a/1', 120)
+        open(os.path.join(self.directory, 'tmp-interrupted'), 'w').close()
+        os.utime(os.path.join(self.directory, 'tmp-interrupted'),
+                 (time.time() - 120,) * 2)
+        self.cache.pruned = 0
+        self.cache.put('http://a/2', b'new')
+        self.assertEqual(os.listdir(self.directory),
+                         [os.path.basename(self.cache.filename('http://a/2'))])
+
+    def test_clear(self):
+        self.cache.put('http://a/1', b'page')
+        # a cache of another process sharing the directory
+        other = ist.PageCache(60, self.directory)
+        self.cache.clear()
+        self.assertIsNone(self.cache.get('http://a/1'))
+        self.assertIsNone(other.get('http://a/1'))
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+class StreamTableTest(unittest.TestCase):
+    def table(self, rows, max_width=None, sample=100):
+        def run():
+            tbl = ist.StreamTable(['peer', 'state'], max_width, sample)
+            for row in rows:
+                tbl.add_row(row)
+            tbl.close()
+        return captured(run)[1].splitlines()
+
+    def test_sampled_widths(self):
+        # rows after the sample may be longer than those in it
+        lines = self.table([['vrouter%d' % i, 'up'] for i in range(101)])
+        # vrouter99 and state, plus headroom
+        self.assertEqual(lines[0], '+' + '-' * 13 + '+' + '-' * 9 + '+')
+        self.assertEqual(lines[-2], '| vrouter100  | up      |')
+        self.assertEqual(len(lines), 101 + 4)
+
+    def test_max_width(self):
+        lines = self.table([['a', 'up']], max_width=12)
+        self.assertEqual(lines, ['+' + '-' * 14 + '+' + '-' * 14 + '+',
+                                 '| peer         | state        |',
+                                 '+' + '-' * 14 + '+' + '-' * 14 + '+',
+                                 '| a            | up           |',
+                                 '+' + '-' * 14 + '+' + '-' * 14 + '+'])
+
+    def test_wrap(self):
+        lines = self.table([['aaa bbb ccc', 'x'],
+                            ['vrouter-100.example', 'y']], max_width=7)
+        # between words only, a longer word overflows its column
+        self.assertEqual(lines[3:6], ['| aaa bbb | x       |',
+                                      '| ccc     |         |',
+                                      '| vrouter-100.example | y       |'])
+
+
+class RouteChurnTest(unittest.TestCase):
+    """ ctr route churn over route summaries polled on a fake clock """
+    Polls = [{'blue.inet.0': (100, 200), 'red.inet.0': (10, 10)},
+             {'blue.inet.0': (150, 300), 'red.inet.0': (10, 10)},
+             {'blue.inet.0': (130, 260), 'red.inet.0': (12, 12)}]
+
+    def setUp(self):
+        parser = argparse.ArgumentParser(prog='ist')
+        self.cli = ist.CLI_ctr(parser, 'localhost', 0, None)
+        self.parser = parser
+        self.clock = [0.0]
+        self.time = ist.time
+        ist.time = type('Clock', (), {
+            'time': staticmethod(lambda: self.clock[0]),
+            'sleep': staticmethod(lambda s: self.advance(s))})
+
+    def tearDown(self):
+        ist.time = self.time
+
+    def advance(self, seconds):
+        self.clock[0] += seconds
+
+    def summary(self, counts):
+        return etree.fromstring(
+            '<ShowRouteSummaryResp><tables><list>' + ''.join(
+                '<ShowRouteTableSummary><name>%s</name>'
+                '<prefixes>%d</prefixes><paths>%d</paths>'
+                '</ShowRouteTableSummary>' % (name, prefixes, paths)
+                for name, (prefixes, paths) in sorted(counts.items())) +
+            '</list></tables></ShowRouteSummaryResp>')
+
+    def churn(self, *argv):
+        polls = iter(self.Polls)
+        IST = self.cli.IST
+
+        def get(path, stream=False):
+            IST.output_etree = [self.summary(next(polls))]
+        IST.get = get
+        IST.tables = []
+        args = self.parser.parse_args(['route', 'churn', '-i', '10s',
+                                       '--count', '2'] + list(argv))
+        captured(args.func, args)
+        return IST.tables
+
+    def test_rates(self):
+        tables = self.churn()
+        self.assertEqual(tables[0][1], [
+            ['blue.inet.0', 150, '5.0', '5.0/5.0/5.0',
+             300, '10.0', '10.0/10.0/10.0'],
+            ['red.inet.0', 10, '0.0', '0.0/0.0/0.0', 10, '0.0', '0.0/0.0/0.0']])
+        self.assertEqual(tables[1][1], [
+            ['blue.inet.0', 130, '-2.0', '-2.0/1.5/5.0',
+             260, '-4.0', '-4.0/3.0/10.0'],
+            ['red.inet.0', 12, '0.2', '0.0/0.1/0.2', 12, '0.2', '0.0/0.1/0.2']])
+
+    def test_window_and_top(self):
+        tables = self.churn('--window', '1', '--top', '1')
+        self.assertEqual(tables[1][1], [
+            ['blue.inet.0', 130, '-2.0', '-2.0/-2.0/-2.0',
+             260, '-4.0', '-4.0/-4.0/-4.0']])
+
+    def test_invalid(self):
+        for argv in [['--window', '0'], ['--top', '-1'], ['--top', 'x']]:
+            stderr = sys.stderr
+            sys.stderr = open(os.devnull, 'w')
+            try:
+                self.assertRaises(SystemExit, self.parser.parse_args,
+                                  ['route', 'churn'] + argv)
+            finally:
+                sys.stderr.close()
+                sys.stderr = stderr
+
+
+class MetricSamplesTest(unittest.TestCase):
+    Doc = ('<BgpNeighborResp>'
+           '<peer type="string">vrouter1</peer>'
+           '<flap_count type="u32">3</flap_count>'
+           '<up type="bool">true</up>'
+           '<rate type="double">nan</rate>'
+           '<state type="string">Established</state>'
+           '<rx type="struct"><Counters><total type="u64">7</total>'
+           '<name type="string">rx</name></Counters></rx>'
+           '<routes type="list"><list><element>1</element></list></routes>'
+           '<more type="bool">true</more>'
+           '</BgpNeighborResp>')
+
+    def test_leaves(self):
+        self.assertEqual(
+            list(ist.metric_samples(etree.fromstring(self.Doc), 'bgp')),
+            [('bgp_flap_count', 3.0, None), ('bgp_up', 1.0, None),
+             ('bgp_rx_total', 7.0, None)])
+
+    def test_fields(self):
+        # listed text fields become info samples valued 1
+        self.assertEqual(
+            list(ist.metric_samples(etree.fromstring(self.Doc), 'bgp',
+                                    ['flap_count', 'state', 'rate'])),
+            [('bgp_flap_count', 3.0, None),
+             ('bgp_rate', 1.0, 'nan'),
+             ('bgp_state', 1.0, 'Established')])
+
+    def test_metric_value(self):
+        self.assertEqual([ist.metric_value(t) for t in
+                          ['12', '-1.5', 'false', 'inf', 'nan', 'up', '']],
+                         [12.0, -1.5, 0.0, None, None, None, None])
+
+
+class PrefetchTest(unittest.TestCase):
+    """ --prefetch walks the pages of a serial run """
+    def setUp(self):
+        ist.prefetch = 2
+        self.IST = Introspect('127.0.0.1', port('contrail-control'), None)
+
+    def tearDown(self):
+        ist.prefetch = 0
+        self.IST.close()
+
+    def test_pages(self):
+        self.IST.get('Snh_ShowRouteReq', stream=True)
+        pages = list(self.IST.output_etree)
+        ist.prefetch = 0
+        self.IST.get('Snh_ShowRouteReq')
+        self.assertEqual(serialized(pages), serialized(self.IST.output_etree))
+
+    def test_stop_early(self):
+        # the producer stops once rendering stops after the first page,
+        # instead of walking the remaining pages
+        long = ist_bench.start_servers(10 * ist_bench.Batch_Size, 0, 0,
+                                       Prefetch_Offset)
+        try:
+            IST = Introspect('127.0.0.1',
+                             port('contrail-control', Prefetch_Offset), None)
+            IST.get('Snh_ShowRouteReq', stream=True)
+            for tree in IST.output_etree:
+                break
+            IST.output_etree.close()
+            IST.close()
+            self.assertLess(long[0].requests, 10)
+        finally:
+            for server in long:
+                server.shutdown()
+                server.server_close()
+
+    def test_error(self):
+        self.IST.get('Snh_NoSuchReq', stream=True)
+        self.assertRaises(IntrospectError, list, self.IST.output_etree)
+
+
+class PageArchiveTest(unittest.TestCase):
+    """ --capture then --file replays the same pages offline """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'capture.zip')
+
+    def tearDown(self):
+        ist.capture = None
+        shutil.rmtree(self.directory)
+
+    def test_replay(self):
+        ist.capture = ist.PageArchive(self.filename, 'w')
+        IST = Introspect('127.0.0.1', port('contrail-control'), None)
+        IST.get('Snh_BgpNeighborReq')
+        IST.close()
+        ist.capture.close()
+        ist.capture = None
+        pages = serialized(IST.output_etree)
+        self.assertEqual(len(pages), 3)
+
+        requests = servers[0].requests
+        IST = Introspect('127.0.0.1', port('contrail-control'), self.filename)
+        IST.get('Snh_BgpNeighborReq')
+        self.assertEqual(serialized(IST.output_etree), pages)
+        self.assertEqual(servers[0].requests, requests)
+        self.assertRaises(IntrospectError, IST.get, 'Snh_ShowRouteReq')
+
+
+class PushSearchTest(unittest.TestCase):
+    """ a search is pushed down only when it is a complete key """
+    Candidates = [('ipv4_address', ist.is_ipv4), ('mac', ist.is_mac)]
+
+    def push(self, search, **params):
+        params = OrderedDict([('ipv4_address', params.get('ipv4', '')),
+                              ('mac', params.get('mac', ''))])
+        return ist.push_search(search, params, self.Candidates), params
+
+    def test_rules(self):
+        self.assertEqual(self.push('10.0.0.5'),
+                         (True, {'ipv4_address': '10.0.0.5', 'mac': ''}))
+        self.assertEqual(self.push('2:0:0:0:0:5'),
+                         (True, {'ipv4_address': '', 'mac': '2:0:0:0:0:5'}))
+        # partial keys are left to the client-side contains()
+        for search in ['10.0.0', '10.0.0.', '2:0:0', 'tap', '']:
+            self.assertEqual(self.push(search),
+                             (False, {'ipv4_address': '', 'mac': ''}))
+        # a parameter given explicitly is not overridden
+        self.assertEqual(self.push('10.0.0.5', ipv4='10.0.0.6'),
+                         (False, {'ipv4_address': '10.0.0.6', 'mac': ''}))
+
+    def test_intf(self):
+        parser = argparse.ArgumentParser(prog='ist')
+        cli = ist.CLI_vr(parser, '127.0.0.1', port('contrail-vrouter-agent'),
+                         None)
+        paths = []
+        get = cli.IST.get
+
+        def recorded(path, stream=False):
+            paths.append(path)
+            get(path, stream)
+        cli.IST.get = recorded
+        cli.IST.tables = []
+        for search in ['10.0.0.5', '2:0:0:0:0:5', '10.0.0', 'tap0000001']:
+            args = parser.parse_args(['intf', search])
+            captured(args.func, args)
+        cli.IST.close()
+        self.assertTrue(paths[0].endswith('&mac=&ipv4_address=10.0.0.5'))
+        self.assertTrue(paths[1].endswith('&mac=2:0:0:0:0:5&ipv4_address='))
+        for path in paths[2:]:
+            self.assertTrue(path.endswith('&mac=&ipv4_address='))
+        # tap00000010 to tap0000001f
+        fields, rows = cli.IST.tables[3]
+        self.assertEqual(sorted(row[fields.index('name')] for row in rows),
+                         ['tap%08x' % i for i in range(16, 32)])
+
+
+class RouteLookupTest(unittest.TestCase):
+    """ vr route --lookup-file against the synthetic agent """
+    def test_lookup(self):
+        parser = argparse.ArgumentParser(prog='ist')
+        cli = ist.CLI_vr(parser, '127.0.0.1', port('contrail-vrouter-agent'),
+                         None)
+        cli.IST.tables = []
+        lookup = tempfile.NamedTemporaryFile('w', suffix='.txt')
+        lookup.write('10.0.0.5\n10.9.9.9  # not routed\n\nbogus\n'
+                     '2001:db8::1\n2:0:0:0:0:5\n')
+        lookup.flush()
+        args = parser.parse_args(['route', '--lookup-file', lookup.name])
+        stderr = sys.stderr
+        sys.stderr = tempfile.TemporaryFile('w+')
+        try:
+            captured(args.func, args)
+            sys.stderr.seek(0)
+            errors = sys.stderr.read()
+        finally:
+            sys.stderr.close()
+            sys.stderr = stderr
+            lookup.close()
+            cli.IST.close()
+        fields, rows = cli.IST.tables[0]
+        self.assertEqual(fields, ['address', 'prefix', 'nh_type', 'label',
+                                  'interface', 'peer'])
+        self.assertEqual(rows, [
+            ['10.0.0.5', '10.0.0.5/32', 'interface', '21', 'tap00000005',
+             'LocalVmPort'],
+            ['10.9.9.9', 'no route', '-', '-', '-', '-'],
+            ['bogus', 'invalid address', '-', '-', '-', '-'],
+            ['2001:db8::1', 'unresolved: inet6 table failed',
+             '-', '-', '-', '-'],
+            ['2:0:0:0:0:5', 'unresolved: layer2 table failed',
+             '-', '-', '-', '-']])
+        # the synthetic agent has no inet6 nor layer2 table
+        self.assertIn('ERROR: inet6 table of vrf 0', errors)
+        self.assertIn('ERROR: layer2 table of vrf 0', errors)
+
+
+class ProfileTest(unittest.TestCase):
+    """ --profile phase accounting and counters """
+    def test_nested(self):
+        # time in the inner phase is not charged to the outer one too
+        profile = ist.Profile()
+        inner = profile.timed('parse', lambda: time.sleep(0.2))
+
+        def outer():
+            time.sleep(0.1)
+            inner()
+        profile.timed('network', outer)()
+        report = profile.report()['phases']
+        self.assertEqual(report['network']['calls'], 1)
+        self.assertEqual(report['parse']['calls'], 1)
+        self.assertTrue(0.1 <= report['network']['wall'] < 0.2)
+        self.assertTrue(0.2 <= report['parse']['wall'] < 0.3)
+
+    def profiled(self, offset):
+        """ --profile-json report of ctr nei, run in a child since
+            instrument() wraps the Introspect methods for good """
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'profile.json')
+            with open(os.devnull, 'w') as devnull:
+                subprocess.check_call(
+                    [sys.executable, 'ist.py', '--profile-json', filename,
+                     '--host', '127.0.0.1',
+                     '--port', str(port('contrail-control', offset)),
+                     'ctr', 'nei'],
+                    cwd=os.path.dirname(os.path.abspath(__file__)),
+                    stdout=devnull, stderr=devnull)
+            with open(filename) as f:
+                return json.load(f)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_counters(self):
+        report = self.profiled(Port_Offset)
+        self.assertEqual(report['pages'], 3)
+        self.assertEqual(report['records'], Rows)
+        self.assertEqual(report['phases']['network']['calls'], 3)
+        self.assertEqual(report['phases']['parse']['calls'], 3)
+        self.assertEqual(report['wire_bytes'], report['bytes'])
+
+    def test_gzip(self):
+        report = self.profiled(Gzip_Offset)
+        self.assertEqual(report['pages'], 3)
+        self.assertLess(report['wire_bytes'], report['bytes'])
+
+
+class ShellTest(unittest.TestCase):
+    """ ist shell serves repeated commands from its cache until refresh """
+    def test_cache_and_refresh(self):
+        shell = ist.Shell('127.0.0.1', port('contrail-control'), None)
+        server = servers[0]
+        fetched = []
+        try:
+            for line in ['ctr nei', 'ctr nei', 'refresh', 'ctr nei']:
+                requests = server.requests
+                result, text = captured(shell.run, line)
+                fetched.append((server.requests - requests, text))
+        finally:
+            ist.cache = None
+            for cli in shell.clis.values():
+                cli.IST.close()
+        self.assertEqual([n for n, text in fetched], [3, 0, 0, 3])
+        self.assertIn('vrouter%d ' % (Rows - 1), fetched[0][1])
+        self.assertEqual(fetched[1][1], fetched[0][1])
+        self.assertEqual(fetched[3][1], fetched[0][1])
+
+
+if __name__ == '__main__':
+    unittest.main()